@@ -1,4 +1,3 @@
-import copy
 import logging
 
 from tqdm import tqdm
@@ -14,7 +13,7 @@ class Arena():
     def __init__(self, player1, player2, display=None):
         """
         Input:
-            player 1,2: two functions that takes board as input, return action
+            player 1,2: two functions that takes board as input, return action (0-80)
             game: Game object
             display: a function that takes board as input and prints it (e.g.
                      display in othello/OthelloGame). Is necessary for verbose
@@ -39,25 +38,27 @@ class Arena():
         """
         players = [self.player2, None, self.player1]
         curPlayer = 1
-        board = copy.deepcopy(GameRepresentationFunctional.INITIAL_STATE)
+        board = GameRepresentationFunctional.INITIAL_STATE
         it = 0
 
 
         while board[-1] == None:
             it += 1
-            action = players[curPlayer + 1](copy.deepcopy(board))
+            action = players[curPlayer + 1](board)
 
-            valids = GameRepresentationFunctional.getPossibleMoves(*board)
+            valids = GameRepresentationFunctional.getValidMask(*board)
 
             if valids[action] == 0:
                 print(f'Action {action} is not valid!')
                 print(f'valids = {valids}')
                 assert valids[action] > 0
 
-            board = GameRepresentationFunctional.move(*copy.deepcopy(board), *valids[action])
+            board = GameRepresentationFunctional.move_action(*board, action)
+            curPlayer = -curPlayer
 
 
-        return curPlayer * board[-1]  # 1 if player1 wins, -1 if player2 wins, 0 if draw
+        # player1 moves first and plays x, so the winner of the board is already relative to player1
+        return board[-1]  # 1 if player1 wins, -1 if player2 wins, 0 if draw
 
     def playGames(self, num, verbose=False):
         """
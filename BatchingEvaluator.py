@@ -0,0 +1,95 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class BatchingEvaluator():
+    """
+    Shares one network between many searches running in other threads.
+
+    predict / predict_batch have the signature of UltimateTTTNet, so the
+    evaluator can be handed to MCTSNodeLess in place of the network. Calls
+    block until their states were evaluated. A worker thread collects the
+    requests that arrive within maxWait seconds of each other (up to maxBatch
+    states) and evaluates them in one forward pass.
+    """
+
+    def __init__(self, nnet, maxBatch=256, maxWait=0.002):
+        self.nnet = nnet
+        self.device = nnet.device
+        self.maxBatch = maxBatch
+        self.maxWait = maxWait
+        self.requests = queue.Queue()  # (states, valid_masks, future), None stops the worker
+        self.batches = 0
+        self.positions = 0
+        self.worker = threading.Thread(target=self._run, name="BatchingEvaluator", daemon=True)
+        self.worker.start()
+
+    def predict(self, state, valid_mask):
+        policy, value = self.predict_batch([state], [valid_mask])
+        return policy[0], float(value[0])
+
+    def predict_batch(self, states, valid_masks):
+        future = Future()
+        self.requests.put((states, valid_masks, future))
+        return future.result()
+
+    def _collect(self):
+        # blocks for the first request, then gathers more till maxBatch states or maxWait passed
+        request = self.requests.get()
+        if request is None:
+            return None
+        batch = [request]
+        size = len(request[0])
+        deadline = time.monotonic() + self.maxWait
+        while size < self.maxBatch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # finish this batch, stop afterwards
+                self.requests.put(None)
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            states = [state for request in batch for state in request[0]]
+            masks = [mask for request in batch for mask in request[1]]
+            try:
+                policies, values = self.nnet.predict_batch(states, masks)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.positions += len(states)
+            start = 0
+            for request_states, _, future in batch:
+                end = start + len(request_states)
+                future.set_result((policies[start:end], np.asarray(values[start:end])))
+                start = end
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "positions": self.positions,
+            "meanBatch": self.positions / self.batches if self.batches else 0.0,
+        }
+
+    def close(self):
+        """Stops the worker once the pending requests are evaluated"""
+        self.requests.put(None)
+        self.worker.join()
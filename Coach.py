@@ -1,4 +1,3 @@
-import copy
 import logging
 import warnings
 warnings.filterwarnings("ignore")
@@ -14,9 +13,12 @@ import torch
 from tqdm import tqdm
 
 from Arena import Arena
+from EvaluationCache import EvaluationCache
 import GameRepresentationFunctional
+from InferenceNet import for_inference
 from MCTS_NEW import MCTSNodeLess
-from NNet import UltimateTTTNet, state_to_tensor
+from NNet import UltimateTTTNet, state_to_tensor, symmetric_planes
+import QuantizedNet
 from Utils import AverageMeter
 import torch.optim as optim
 
@@ -43,9 +45,36 @@ class Coach():
         print(f"Using device: {self.device}")
         self.pnet = self.nnet.__class__().to(self.device)  # create a new instance of the neural network
         self.args = args
-        self.mcts = MCTSNodeLess(self.nnet, args["numMCTSSims"])
+        # leaves per batched evaluation, the same for self-play and the int8 arena check
+        self.parallelLeaves = self.args.get("parallelLeaves", 1)
+        self.mcts = self.newMCTS(self.nnet)
         self.trainExamplesHistory = []  
         self.skipFirstSelfPlay = False  # can be overriden in loadTrainExamples()
+        # network evaluations shared by the self-play episodes of one iteration (same model)
+        self.evalCache = EvaluationCache(self.args["evalCacheSize"]) if self.args.get("evalCacheSize") else None
+
+    def newMCTS(self, nnet, evalCache=None):
+        return MCTSNodeLess(nnet, self.args["numMCTSSims"], parallelLeaves=self.parallelLeaves,
+                            maxNodes=self.args.get("maxMCTSNodes"), evalCache=evalCache)
+
+    def selfPlayNet(self):
+        """
+        Network for the self-play searches. With quantizedSelfPlay an int8 copy calibrated on
+        the stored training examples, used only if it keeps up with the float net in the arena.
+        """
+        optimized = for_inference(self.nnet, self.args.get("optimizedInference"))
+        if not self.args.get("quantizedSelfPlay"):
+            return optimized
+        quantized = QuantizedNet.quantize(self.nnet, self.trainExamplesHistory)
+        result = QuantizedNet.compare_strength(self.nnet, quantized, self.args.get("quantizedArenaCompare", 40),
+                                               self.args["numMCTSSims"], self.parallelLeaves,
+                                               self.args.get("quantizedTolerance", 0.1))
+        print('INT8/FLOAT WINS : %d / %d ; DRAWS : %d' % (result["quantizedWins"], result["floatWins"], result["draws"]))
+        if result["passed"]:
+            print('SELF PLAY WITH THE INT8 MODEL')
+            return quantized
+        print('INT8 MODEL TOO WEAK, SELF PLAY WITH THE FLOAT MODEL')
+        return optimized
 
     def executeEpisode(self):
         """
@@ -64,7 +93,7 @@ class Coach():
                            the player eventually won the game, else -1.
         """
         trainExamples = []
-        board = copy.deepcopy(GameRepresentationFunctional.INITIAL_STATE)
+        board = GameRepresentationFunctional.INITIAL_STATE
         self.curPlayer = 1
         episodeStep = 0
 
@@ -72,17 +101,17 @@ class Coach():
             episodeStep += 1
             temp = int(episodeStep < self.args["tempThreshold"])
 
-            pi = self.mcts.getActionProb(copy.deepcopy(board), temp=temp)
-            trainExamples.append([state_to_tensor(board), self.curPlayer, pi, None])
-            sym = GameRepresentationFunctional.get_symmetries(*board) #TODO: get symmetries for pi 
-            pi_sym = GameRepresentationFunctional.flip_arr(np.array(pi).tolist())
-            for sym_board, sym_pi in zip(sym, pi_sym):
-                trainExamples.append([state_to_tensor(sym_board), self.curPlayer, sym_pi, None])
+            pi = self.mcts.getActionProb(board, temp=temp)
+            planes = state_to_tensor(board)
+            trainExamples.append([planes, self.curPlayer, pi, None])
+            planes_sym = symmetric_planes(planes)
+            pi_sym = GameRepresentationFunctional.flip_arr(pi)
+            for sym_planes, sym_pi in zip(planes_sym, pi_sym):
+                trainExamples.append([sym_planes, self.curPlayer, sym_pi, None])
 
-            valid = GameRepresentationFunctional.getPossibleMoves(*board)
-            action = np.random.choice(len(pi), p=pi)  # pick an action according to the policy
+            action = np.random.choice(len(pi), p=pi)  # pick an action (0-80) according to the policy
             
-            board = GameRepresentationFunctional.move(*board, *valid[action])
+            board = GameRepresentationFunctional.move_action(*board, action)
 
             r = board[-1] != None
 
@@ -105,9 +134,15 @@ class Coach():
             if not self.skipFirstSelfPlay or i > 1:
                 iterationTrainExamples = deque([], maxlen=self.args["maxlenOfQueue"])
 
+                # the network is fixed during self-play, optimize it once for all episodes
+                selfPlayNet = self.selfPlayNet()
+                if self.evalCache is not None:
+                    self.evalCache.set_version(i)  # the network changes every iteration
                 for _ in tqdm(range(self.args["numEps"]), desc="Self Play"):
-                    self.mcts = MCTSNodeLess(self.nnet)  # reset search tree
+                    self.mcts = self.newMCTS(selfPlayNet, self.evalCache)  # reset search tree
                     iterationTrainExamples += self.executeEpisode()
+                if self.evalCache is not None:
+                    log.info(f"evaluation cache: {self.evalCache.stats()}")
 
                 # save the iteration examples to the history 
                 self.trainExamplesHistory.append(iterationTrainExamples)
@@ -129,10 +164,10 @@ class Coach():
             # training new network, keeping a copy of the old one
             self.nnet.save_checkpoint(folder=self.args["checkpoint"], filename='temp.pth.tar')
             self.pnet.load_checkpoint(folder=self.args["checkpoint"], filename='temp.pth.tar')
-            pmcts = MCTSNodeLess(self.pnet)
+            pmcts = self.newMCTS(for_inference(self.pnet, self.args.get("optimizedInference")))
 
             self.train(trainExamples)
-            nmcts = MCTSNodeLess(self.nnet)
+            nmcts = self.newMCTS(for_inference(self.nnet, self.args.get("optimizedInference")))
 
             print('PITTING AGAINST PREVIOUS VERSION')
             arena = Arena(lambda x: np.argmax(pmcts.getActionProb(x, temp=0)),
@@ -232,6 +267,13 @@ if __name__ == "__main__":
         'numMCTSSims': 100,          # Number of games moves for MCTS to simulate.
         'arenaCompare': 10,         # Number of games to play during arena play to determine if new net will be accepted.
         'cpuct': 1,             # Upper confidence bound for MCTS exploration.
+        'parallelLeaves': 8,        # Number of MCTS leaves evaluated together in one batched forward pass.
+        'maxMCTSNodes': 200000,     # Cap on the positions kept in each MCTS node table (about 1.5 kB each).
+        'evalCacheSize': 100000,    # Network evaluations shared by the self-play episodes of an iteration (about 0.5 kB each), 0 disables.
+        'optimizedInference': True, # Search with the fused, scripted CPU net (InferenceNet), None follows InferenceNet.OPTIMIZED.
+        'quantizedSelfPlay': False, # Self-play with an int8 net (QuantizedNet) if it passes the arena check against the float net.
+        'quantizedArenaCompare': 40,# Number of arena games of the int8 net against the float net.
+        'quantizedTolerance': 0.1,  # Largest score loss of the int8 net against the float net (0.5 is even).
         'checkpoint': './temp/',
         'load_model': False,
         "epochs": 10,  
@@ -0,0 +1,224 @@
+import multiprocessing
+import threading
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import GameRepresentationFunctional
+
+# Network evaluations (policy, value) keyed by the position hash MCTSNodeLess uses for its
+# nodes. With symmetries that is the canonical hash and the policy is stored in the canonical
+# frame, so all 8 symmetric positions share one entry. An entry is only valid for the model
+# that produced it: set_version() drops everything when the model changes.
+
+
+def _stats(hits, misses, entries, maxEntries, evictions, version):
+    lookups = hits + misses
+    return {
+        "entries": entries,
+        "maxEntries": maxEntries,
+        "hits": hits,
+        "misses": misses,
+        "hitRate": hits / lookups if lookups else 0.0,
+        "evictions": evictions,
+        "version": version,
+    }
+
+
+class EvaluationCache():
+    """
+    Size-bounded LRU cache of evaluations for the searches of one process.
+    Thread safe, so one cache can serve many searches, e.g. all games of
+    EngineService or all self-play episodes of Coach.
+    """
+
+    def __init__(self, maxEntries=100000, version=None, symmetric=True):
+        self.maxEntries = maxEntries
+        self.symmetric = symmetric  # keys are canonical hashes (useSymmetries of MCTSNodeLess)
+        self.version = version
+        self.entries = OrderedDict()  # hash -> (policy, value), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, h):
+        """(policy, value) of hash h or None. The policy must not be modified."""
+        with self.lock:
+            entry = self.entries.get(h)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(h)
+            self.hits += 1
+            return entry
+
+    def put(self, h, policy, value):
+        with self.lock:
+            self.entries[h] = (policy, value)
+            self.entries.move_to_end(h)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def set_version(self, version):
+        """Ties the cache to a model, drops all entries if version differs from the current one"""
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+
+    def stats(self):
+        return _stats(self.hits, self.misses, len(self.entries), self.maxEntries, self.evictions, self.version)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+# shared memory layout: a set associative table of numSets sets with `ways` entries each.
+# A hash can only live in set h % numSets, inside a set the least recently used entry is
+# replaced. Key 0 marks an empty entry.
+_COUNTERS = ("version", "clock", "hits", "misses", "evictions", "entries")
+
+def _layout(numSets, ways):
+    return [
+        ("counters", (len(_COUNTERS),), np.int64),
+        ("keys", (numSets, ways), np.uint64),
+        ("stamps", (numSets, ways), np.int64),  # clock of the last use
+        ("policies", (numSets, ways, GameRepresentationFunctional.NUM_ACTIONS), np.float32),
+        ("values", (numSets, ways), np.float32),
+    ]
+
+def _views(buf, numSets, ways):
+    views = {}
+    offset = 0
+    for name, shape, dtype in _layout(numSets, ways):
+        views[name] = np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return views
+
+def _size(numSets, ways):
+    return sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, shape, dtype in _layout(numSets, ways))
+
+
+class SharedEvaluationCache():
+    """
+    Evaluation cache in shared memory for searches in several processes, with the
+    interface of EvaluationCache. The model version is an int. Pass the cache to
+    the worker processes as an argument (start them from the same multiprocessing
+    context), they attach to the shared memory on first use. The creating process
+    owns the memory and has to call close().
+    """
+
+    def __init__(self, maxEntries=100000, version=0, symmetric=True, ways=4, context=None):
+        self.ways = ways
+        self.numSets = max(1, maxEntries // ways)
+        self.maxEntries = self.numSets * ways
+        self.symmetric = symmetric
+        self.lock = (context or multiprocessing.get_context("spawn")).Lock()
+        self.shm = shared_memory.SharedMemory(create=True, size=_size(self.numSets, ways))
+        self.shmName = self.shm.name
+        self.owner = True
+        self.views = _views(self.shm.buf, self.numSets, ways)
+        self.views["counters"][:] = 0
+        self.views["keys"][:] = 0
+        self.views["counters"][_COUNTERS.index("version")] = version
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["shm"] = None
+        state["views"] = None
+        state["owner"] = False
+        return state
+
+    def _attach(self):
+        if self.views is None:
+            self.shm = shared_memory.SharedMemory(name=self.shmName)
+            self.views = _views(self.shm.buf, self.numSets, self.ways)
+        return self.views
+
+    def _count(self, counter, n=1):
+        self.views["counters"][_COUNTERS.index(counter)] += n
+
+    def _tick(self):
+        self._count("clock")
+        return self.views["counters"][_COUNTERS.index("clock")]
+
+    @property
+    def version(self):
+        return int(self._attach()["counters"][_COUNTERS.index("version")])
+
+    def __len__(self):
+        return int(self._attach()["counters"][_COUNTERS.index("entries")])
+
+    def get(self, h):
+        """(policy, value) of hash h or None, the policy is a copy"""
+        views = self._attach()
+        i = h % self.numSets
+        with self.lock:
+            ways = np.flatnonzero(views["keys"][i] == np.uint64(h))
+            if not h or not len(ways):
+                self._count("misses")
+                return None
+            way = ways[0]
+            views["stamps"][i, way] = self._tick()
+            self._count("hits")
+            return views["policies"][i, way].copy(), float(views["values"][i, way])
+
+    def put(self, h, policy, value):
+        if not h:
+            return
+        views = self._attach()
+        i = h % self.numSets
+        with self.lock:
+            keys = views["keys"][i]
+            ways = np.flatnonzero(keys == np.uint64(h))
+            if len(ways):
+                way = ways[0]
+            else:
+                empty = np.flatnonzero(keys == 0)
+                if len(empty):
+                    way = empty[0]
+                    self._count("entries")
+                else:
+                    way = int(np.argmin(views["stamps"][i]))
+                    self._count("evictions")
+                keys[way] = h
+            views["policies"][i, way] = policy
+            views["values"][i, way] = value
+            views["stamps"][i, way] = self._tick()
+
+    def set_version(self, version):
+        """Ties the cache to a model, drops all entries if version differs from the current one"""
+        views = self._attach()
+        with self.lock:
+            if version != views["counters"][_COUNTERS.index("version")]:
+                views["keys"][:] = 0
+                views["counters"][_COUNTERS.index("entries")] = 0
+                views["counters"][_COUNTERS.index("version")] = version
+
+    def stats(self):
+        counters = dict(zip(_COUNTERS, (int(c) for c in self._attach()["counters"])))
+        return _stats(counters["hits"], counters["misses"], counters["entries"], self.maxEntries, counters["evictions"], counters["version"])
+
+    def clear(self):
+        views = self._attach()
+        with self.lock:
+            views["keys"][:] = 0
+            for counter in ("hits", "misses", "evictions", "entries"):
+                views["counters"][_COUNTERS.index(counter)] = 0
+
+    def close(self):
+        """Detaches this process, the owner also frees the shared memory"""
+        if self.shm is not None:
+            self.views = None
+            self.shm.close()
+            if self.owner:
+                self.shm.unlink()
+            self.shm = None
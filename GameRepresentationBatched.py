@@ -0,0 +1,215 @@
+import time
+import numpy as np
+
+import GameRepresentationFunctional
+
+# batched counterpart of GameRepresentationFunctional
+# state for N games = (global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner)
+#   global_state_x / global_state_o: (N,) uint16
+#   local_state_x / local_state_o:   (N, 9) uint16
+#   currentPlayer:                   (N,) bool, True is x
+#   currentBoard:                    (N,) int8, 0-8 are the local boards, 9 is free choice
+#   winner:                          (N,) int8, 1 / -1 / 0 like the functional winner, ONGOING for None
+# moves are flat indices y * 9 + x into the 81 squares, the same layout the network policy uses
+
+ONGOING = 2
+
+# WIN_TABLE[mask] is True if the 9-bit mask contains three in a row
+WIN_TABLE = np.array(GameRepresentationFunctional.WIN_TABLE, dtype=bool)
+
+# FREE_TABLE[occupied, cell] is True if cell is empty on a local board with that occupancy
+FREE_TABLE = ((~np.arange(512)[:, None] >> np.arange(9)) & 1).astype(bool)
+
+# local board and cell of every flat square index
+FLAT_TO_BOARD = np.array([(flat // 27) * 3 + (flat % 9) // 3 for flat in range(81)], dtype=np.int64)
+FLAT_TO_CELL = np.array([((flat // 9) % 3) * 3 + flat % 3 for flat in range(81)], dtype=np.int64)
+
+
+def initial_state(n):
+    return (
+        np.zeros(n, dtype=np.uint16),
+        np.zeros(n, dtype=np.uint16),
+        np.zeros((n, 9), dtype=np.uint16),
+        np.zeros((n, 9), dtype=np.uint16),
+        np.ones(n, dtype=bool),
+        np.full(n, 9, dtype=np.int8),
+        np.full(n, ONGOING, dtype=np.int8),
+    )
+
+def from_states(states):
+    # packs a list of functional states into one batched state
+    n = len(states)
+    batch = initial_state(n)
+    global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner = batch
+    for i, (gx, go, lx, lo, player, board, win) in enumerate(states):
+        global_state_x[i] = gx
+        global_state_o[i] = go
+        local_state_x[i] = lx
+        local_state_o[i] = lo
+        currentPlayer[i] = bool(player)
+        currentBoard[i] = board
+        winner[i] = ONGOING if win is None else win
+    return batch
+
+def to_states(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner):
+    # unpacks a batched state into a list of functional states
+    states = []
+    for i in range(len(global_state_x)):
+        states.append((
+            int(global_state_x[i]),
+            int(global_state_o[i]),
+            tuple(int(b) for b in local_state_x[i]),
+            tuple(int(b) for b in local_state_o[i]),
+            bool(currentPlayer[i]),
+            int(currentBoard[i]),
+            None if winner[i] == ONGOING else int(winner[i]),
+        ))
+    return states
+
+def getActiveBoards(global_state_x, global_state_o, currentBoard, winner):
+    # returns a (N,) 9-bit mask of the local boards the current player may play on
+    free_boards = ~(global_state_x | global_state_o).astype(np.int64) & 0b111111111
+    active_boards = np.where(currentBoard == 9, free_boards, 1 << np.minimum(currentBoard, 8).astype(np.int64))
+    active_boards &= free_boards
+    active_boards[winner != ONGOING] = 0
+    return active_boards
+
+def getPossibleMovesMask(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner):
+    # returns a (N, 81) bool array of legal moves, all False for finished games
+    n = len(global_state_x)
+    active_boards = getActiveBoards(global_state_x, global_state_o, currentBoard, winner)
+    playable = ((active_boards[:, None] >> np.arange(9)) & 1).astype(bool)  # (N, 9)
+    board_cell = FREE_TABLE[local_state_x | local_state_o]  # (N, 9, 9)
+    board_cell &= playable[:, :, None]
+
+    # (N, board_y, board_x, cell_y, cell_x) -> (N, y, x)
+    return board_cell.reshape(n, 3, 3, 3, 3).transpose(0, 1, 3, 2, 4).reshape(n, 81)
+
+def checkWin(boards):
+    return WIN_TABLE[boards.astype(np.int64)]
+
+def checkDraw(boards_x, boards_o):
+    return (boards_x | boards_o) == 0b111111111
+
+def move(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner, actions):
+    # applies one move per game and returns (next_state, valid)
+    # finished games and invalid moves leave their game unchanged and are marked False in valid
+    # for every valid game next_state is identical to GameRepresentationFunctional.move
+    n = len(global_state_x)
+    actions = np.asarray(actions, dtype=np.int64)
+    rows = np.arange(n)
+    in_bounds = np.clip(actions, 0, 80)
+    active_boards = getActiveBoards(global_state_x, global_state_o, currentBoard, winner)
+    occupied = (local_state_x | local_state_o)[rows, FLAT_TO_BOARD[in_bounds]].astype(np.int64)
+    valid = (
+        (actions >= 0) & (actions < 81)
+        & (active_boards >> FLAT_TO_BOARD[in_bounds] & 1).astype(bool)
+        & ~(occupied >> FLAT_TO_CELL[in_bounds] & 1).astype(bool)
+    )
+
+    global_state_x = global_state_x.copy()
+    global_state_o = global_state_o.copy()
+    local_state_x = local_state_x.copy()
+    local_state_o = local_state_o.copy()
+    currentPlayer = currentPlayer.copy()
+    currentBoard = currentBoard.copy()
+    winner = winner.copy()
+
+    idx = rows[valid]
+    if len(idx) == 0:
+        return (global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner), valid
+
+    board = FLAT_TO_BOARD[actions[idx]]
+    cell = FLAT_TO_CELL[actions[idx]]
+    bit = (1 << cell).astype(np.uint16)
+    board_bit = (1 << board).astype(np.uint16)
+    is_x = currentPlayer[idx]
+
+    # Update the local board
+    local_state_x[idx[is_x], board[is_x]] |= bit[is_x]
+    local_state_o[idx[~is_x], board[~is_x]] |= bit[~is_x]
+    lx = local_state_x[idx, board]
+    lo = local_state_o[idx, board]
+
+    # Check if the current player won the local board
+    local_won = checkWin(np.where(is_x, lx, lo))
+    gx = global_state_x[idx] | np.where(local_won & is_x, board_bit, 0).astype(np.uint16)
+    go = global_state_o[idx] | np.where(local_won & ~is_x, board_bit, 0).astype(np.uint16)
+    game_won = local_won & np.where(is_x, checkWin(gx & ~go), checkWin(go & ~gx))
+
+    # Check if the local board is a draw (full but no winner)
+    local_draw = ~local_won & checkDraw(lx, lo)
+    gx = gx | np.where(local_draw, board_bit, 0).astype(np.uint16)
+    go = go | np.where(local_draw, board_bit, 0).astype(np.uint16)
+
+    # Check if the game is a draw (all local boards are won or drawn)
+    game_draw = ~game_won & checkDraw(gx, go)
+    global_state_x[idx] = gx
+    global_state_o[idx] = go
+    winner[idx] = np.where(game_won, np.where(is_x, 1, -1), np.where(game_draw, 0, ONGOING))
+
+    # Determine the next board and switch player for games that go on
+    going_on = ~game_won & ~game_draw
+    next_board = np.where((gx | go).astype(np.int64) >> cell & 1, 9, cell)
+    currentBoard[idx[going_on]] = next_board[going_on]
+    currentPlayer[idx[going_on]] = ~is_x[going_on]
+
+    return (global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner), valid
+
+def random_actions(mask, rng=None):
+    # picks one uniformly random legal move per game, -1 for games without legal moves
+    rng = np.random.default_rng() if rng is None else rng
+    scores = rng.random(mask.shape, dtype=np.float32)
+    scores *= mask
+    actions = np.argmax(scores, axis=1)
+    actions[~mask.any(axis=1)] = -1
+    return actions
+
+def random_playout(state, rng=None, max_moves=81):
+    # plays every game of the batch to the end with uniformly random moves and returns the winners
+    winner = state[-1].copy()
+    games = np.flatnonzero(winner == ONGOING)
+    state = tuple(part[games] for part in state)
+    for _ in range(max_moves):
+        if len(games) == 0:
+            break
+        actions = random_actions(getPossibleMovesMask(*state), rng)
+        state, _ = move(*state, actions)
+        # only keep stepping the games that are still running
+        ongoing = state[-1] == ONGOING
+        winner[games[~ongoing]] = state[-1][~ongoing]
+        games = games[ongoing]
+        state = tuple(part[ongoing] for part in state)
+    return winner
+
+def check_equivalence(num_games=1000, seed=0):
+    # steps num_games random games with both engines and compares every intermediate state
+    rng = np.random.default_rng(seed)
+    batch = initial_state(num_games)
+    states = [GameRepresentationFunctional.INITIAL_STATE] * num_games
+    for _ in range(81):
+        mask = getPossibleMovesMask(*batch)
+        for i, state in enumerate(states):
+            expected = sorted(y * 9 + x for x, y in GameRepresentationFunctional.getPossibleMoves(*state))
+            assert expected == list(np.flatnonzero(mask[i])), f"move mask mismatch in game {i}"
+        actions = random_actions(mask, rng)
+        batch, valid = move(*batch, actions)
+        for i, action in enumerate(actions):
+            if valid[i]:
+                states[i] = GameRepresentationFunctional.move(*states[i], action % 9, action // 9)
+        assert to_states(*batch) == states, "state mismatch"
+        if not valid.any():
+            break
+    return True
+
+def benchmark_random_games(num_games=10**5):
+    start = time.time()
+    random_playout(initial_state(num_games))
+    end = time.time()
+    print(f"Time taken: {end - start} seconds")
+    return end - start
+
+
+if __name__ == "__main__":
+    check_equivalence()
+    benchmark_random_games(10**5)
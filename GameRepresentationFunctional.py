@@ -1,5 +1,5 @@
-import copy
 import random
+import struct
 import time
 import numpy as np
 
@@ -39,13 +39,72 @@ WIN_MASKS = [
     0b100010001,
     0b001010100,
 ]
+
+# lookup tables indexed by a 9-bit local mask
+# order of cells matches the x-major loop of the original move generation
+CELL_ORDER = [local_y * 3 + local_x for local_x in range(3) for local_y in range(3)]
+
+# WIN_TABLE[mask] is True if the mask contains three in a row
+WIN_TABLE = tuple(any((mask & win) == win for win in WIN_MASKS) for mask in range(512))
+
+# EMPTY_CELLS[occupied] lists the free cell indices of a local board
+EMPTY_CELLS = tuple(tuple(idx for idx in CELL_ORDER if not occupied & (1 << idx)) for occupied in range(512))
+
+# MOVE_TABLE[board][occupied] lists the global (x, y) moves of a local board
+MOVE_TABLE = tuple(
+    tuple(
+        tuple((idx % 3 + board % 3 * 3, idx // 3 + board // 3 * 3) for idx in EMPTY_CELLS[occupied])
+        for occupied in range(512)
+    )
+    for board in range(9)
+)
+
+# actions are the canonical indices 0-80 of the squares, action = global_y * 9 + global_x
+# this is the layout of the network policy and of every policy vector in MCTS and training
+NUM_ACTIONS = 81
+
+# ACTION_TABLE[board][occupied] lists the actions of a local board, in MOVE_TABLE order
+ACTION_TABLE = tuple(
+    tuple(tuple(y * 9 + x for x, y in moves) for moves in board_moves)
+    for board_moves in MOVE_TABLE
+)
+
+# ACTION_BITS_TABLE[board][occupied] is the same set as a bitmask, bit a for action a
+ACTION_BITS_TABLE = tuple(
+    tuple(sum(1 << a for a in actions) for actions in board_actions)
+    for board_actions in ACTION_TABLE
+)
+
+# ACTION_SYMMETRIES[i][a] is the action a of a state becomes in its i-th symmetry (see get_symmetries)
+# the symmetry moves local board b to SYMMETRY_INDICES[i][b] and cell c inside it to SYMMETRY_INDICES[i][c]
+ACTION_SYMMETRIES = tuple(
+    tuple(
+        ((perm[(a // 27) * 3 + (a % 9) // 3] // 3) * 3 + perm[((a // 9) % 3) * 3 + a % 3] // 3) * 9
+        + (perm[(a // 27) * 3 + (a % 9) // 3] % 3) * 3 + perm[((a // 9) % 3) * 3 + a % 3] % 3
+        for a in range(81)
+    )
+    for perm in SYMMETRY_INDICES
+)
+
+# INVERSE_ACTION_SYMMETRIES[i] maps an action of the i-th symmetry back to the original state
+INVERSE_ACTION_SYMMETRIES = tuple(
+    tuple(perm.index(a) for a in range(81))
+    for perm in ACTION_SYMMETRIES
+)
+
+# (8, 81) gather indices: policy[SYMMETRY_GATHER[i]] is the policy of the i-th symmetry
+SYMMETRY_GATHER = np.array(INVERSE_ACTION_SYMMETRIES, dtype=np.int64)
+# and policy_sym[INVERSE_SYMMETRY_GATHER[i]] maps the policy of the i-th symmetry back
+INVERSE_SYMMETRY_GATHER = np.array(ACTION_SYMMETRIES, dtype=np.int64)
     
 
+# states are immutable: the local boards are tuples and move() returns a new state,
+# so callers can share states freely without copying them
 INITIAL_STATE = (
     0b000000000, #global_state x
     0b000000000, # global state o
-    [0b000000000] * 9, # local state x
-    [0b000000000] * 9, # local state o
+    (0b000000000,) * 9, # local state x
+    (0b000000000,) * 9, # local state o
     True, # currentplayer
     9, # 0-8 are the local boards, 9 is free choice
     None, # winner
@@ -213,7 +272,36 @@ ZOBRIST_TABLE = {
     ],
     "players": [5407203028010692663, 14035603769899813055],
 }
-def zobrist(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner):
+
+# SYMMETRY_ZOBRIST_TABLES[i] hashes a state like ZOBRIST_TABLE hashes its i-th symmetry (see get_symmetries)
+SYMMETRY_ZOBRIST_TABLES = [
+    {
+        "squares": [[ZOBRIST_TABLE["squares"][perm[board]][perm[pos]] for pos in range(9)] for board in range(9)],
+        "boards": [ZOBRIST_TABLE["boards"][perm[board]] for board in range(9)],
+        "next_board": [ZOBRIST_TABLE["next_board"][perm[board]] for board in range(9)],
+        "players": ZOBRIST_TABLE["players"],
+    }
+    for perm in SYMMETRY_INDICES
+]
+
+# SYMMETRY_ZOBRIST_TABLE packs the 8 tables into one: every key holds the 8 keys in 64-bit lanes,
+# so zobrist() and zobrist_update() with it hash all symmetries at once (xor never crosses lanes)
+def _pack_zobrist_keys(keys):
+    return sum(key << (64 * lane) for lane, key in enumerate(keys))
+
+SYMMETRY_ZOBRIST_TABLE = {
+    "squares": [
+        [[_pack_zobrist_keys(table["squares"][board][pos][player] for table in SYMMETRY_ZOBRIST_TABLES) for player in range(2)] for pos in range(9)]
+        for board in range(9)
+    ],
+    "boards": [
+        [_pack_zobrist_keys(table["boards"][board][kind] for table in SYMMETRY_ZOBRIST_TABLES) for kind in range(3)]
+        for board in range(9)
+    ],
+    "next_board": [_pack_zobrist_keys(table["next_board"][board] for table in SYMMETRY_ZOBRIST_TABLES) for board in range(9)],
+    "players": [_pack_zobrist_keys(table["players"][player] for table in SYMMETRY_ZOBRIST_TABLES) for player in range(2)],
+}
+def zobrist(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner, table=ZOBRIST_TABLE):
     h = 0
     
     # Hash the local boards
@@ -222,52 +310,142 @@ def zobrist(global_state_x, global_state_o, local_state_x, local_state_o, curren
         board_x = local_state_x[board_idx]
         for pos in range(9):
             if board_x & (1 << pos):
-                h ^= ZOBRIST_TABLE["squares"][board_idx][pos][0]
+                h ^= table["squares"][board_idx][pos][0]
         
         # Hash O's pieces on this local board
         board_o = local_state_o[board_idx]
         for pos in range(9):
             if board_o & (1 << pos):
-                h ^= ZOBRIST_TABLE["squares"][board_idx][pos][1]
+                h ^= table["squares"][board_idx][pos][1]
     
     # Hash the global boards (won boards)
     for board_idx in range(9):
         if global_state_x & (1 << board_idx):
-            h ^= ZOBRIST_TABLE["boards"][board_idx][0]
+            h ^= table["boards"][board_idx][0]
         if global_state_o & (1 << board_idx):
-            h ^= ZOBRIST_TABLE["boards"][board_idx][1]
+            h ^= table["boards"][board_idx][1]
         # For drawn boards (both X and O have the bit set)
         if (global_state_x & global_state_o) & (1 << board_idx):
-            h ^= ZOBRIST_TABLE["boards"][board_idx][2]
+            h ^= table["boards"][board_idx][2]
     
     # Hash the current board
     if currentBoard != 9:  # 9 means free choice
-        h ^= ZOBRIST_TABLE["next_board"][currentBoard]
+        h ^= table["next_board"][currentBoard]
     
     # Hash the current player
-    h ^= ZOBRIST_TABLE["players"][0 if currentPlayer else 1]
+    h ^= table["players"][0 if currentPlayer else 1]
     
     return h
 
+INITIAL_HASH = zobrist(*INITIAL_STATE)
+
+
+# when True every incremental hash update is checked against the full recomputation
+VERIFY_ZOBRIST = False
+
+def zobrist_update(h, state, next_state, global_x, global_y, table=ZOBRIST_TABLE):
+    # returns the hash of next_state = move(*state, global_x, global_y) given h = zobrist(*state)
+    global_state_x, global_state_o, _, _, currentPlayer, currentBoard, _ = state
+    next_global_x, next_global_o, _, _, nextPlayer, nextBoard, _ = next_state
+
+    # placed square
+    board = (global_y // 3) * 3 + (global_x // 3)
+    h ^= table["squares"][board][(global_y % 3) * 3 + global_x % 3][0 if currentPlayer else 1]
+
+    # newly won or drawn boards
+    changed_x = next_global_x ^ global_state_x
+    changed_o = next_global_o ^ global_state_o
+    changed_draw = (next_global_x & next_global_o) ^ (global_state_x & global_state_o)
+    if changed_x | changed_o:
+        for board_idx in range(9):
+            if changed_x & (1 << board_idx):
+                h ^= table["boards"][board_idx][0]
+            if changed_o & (1 << board_idx):
+                h ^= table["boards"][board_idx][1]
+            if changed_draw & (1 << board_idx):
+                h ^= table["boards"][board_idx][2]
+
+    # next board
+    if currentBoard != nextBoard:
+        if currentBoard != 9:
+            h ^= table["next_board"][currentBoard]
+        if nextBoard != 9:
+            h ^= table["next_board"][nextBoard]
+
+    # player
+    if currentPlayer != nextPlayer:
+        h ^= table["players"][0] ^ table["players"][1]
+
+    if VERIFY_ZOBRIST:
+        verify_zobrist(h, next_state, table)
+    return h
+
+def verify_zobrist(h, state, table=ZOBRIST_TABLE):
+    full = zobrist(*state, table=table)
+    if h != full:
+        raise AssertionError(f"incremental zobrist hash {h} does not match full hash {full}")
+    return True
+
+def move_hashed(h, global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner, global_x, global_y):
+    # move() that also carries the zobrist hash, returns (next_state, next_hash) or (None, h) for invalid moves
+    state = (global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner)
+    next_state = move(*state, global_x, global_y)
+    if next_state is None:
+        return None, h
+    return next_state, zobrist_update(h, state, next_state, global_x, global_y)
+
+
+def symmetric_zobrists(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner, table=SYMMETRY_ZOBRIST_TABLE):
+    # returns the zobrist hashes of all 8 symmetries of the state packed into one int (see unpack_zobrists)
+    return zobrist(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner, table=table)
 
+def symmetric_zobrists_update(hs, state, next_state, global_x, global_y, table=SYMMETRY_ZOBRIST_TABLE):
+    return zobrist_update(hs, state, next_state, global_x, global_y, table)
 
+def unpack_zobrists(hs, count=8):
+    return struct.unpack(f"<{count}Q", hs.to_bytes(8 * count, "little"))
 
+def canonical_from_zobrists(hs, count=8):
+    # returns (canonical hash, symmetry index), the canonical hash is the minimum over the symmetry group
+    hashes = unpack_zobrists(hs, count)
+    h = min(hashes)
+    return h, hashes.index(h)
+
+def canonical_zobrist(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner):
+    # returns (canonical hash, action permutation)
+    # ACTION_SYMMETRIES[sym][a] maps an action of the state to the same action in canonical form
+    h, sym = canonical_from_zobrists(symmetric_zobrists(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner))
+    return h, ACTION_SYMMETRIES[sym]
+
+
+def freeze_state(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner):
+    # adapter for states built with mutable local board lists (old 7-tuple layout)
+    return (global_state_x, global_state_o, tuple(local_state_x), tuple(local_state_o), currentPlayer, currentBoard, winner)
 
 
 def move(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner, global_x, global_y):
+    # returns a new state, the given state is never modified
     board = (global_y // 3) * 3 + (global_x // 3)
     local_x = global_x % 3
     local_y = global_y % 3
-    board_name = local_state_x if currentPlayer else local_state_o
 
     if not checkValidMove(global_state_x, global_state_o, local_state_x, local_state_o, currentBoard, board, local_x, local_y):
         return None
 
     # Update the local board
+    board_name = list(local_state_x if currentPlayer else local_state_o)
     board_name[board] |= (1 << (local_y * 3 + local_x))
+    board_name = tuple(board_name)
+    if currentPlayer:
+        local_state_x = board_name
+        local_state_o = tuple(local_state_o)
+    else:
+        local_state_x = tuple(local_state_x)
+        local_state_o = board_name
 
     # Check if the current player won the local board
-    if checkWin(board_name[board]):
+    local_won = checkWin(board_name[board])
+    if local_won:
         if currentPlayer:
             global_state_x |= (1 << board)
             if checkWin(global_state_x & ~global_state_o):
@@ -280,7 +458,7 @@ def move(global_state_x, global_state_o, local_state_x, local_state_o, currentPl
                 return (global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner)
 
     # Check if the local board is a draw (full but no winner)
-    if checkDraw(local_state_x[board], local_state_o[board]):
+    if not local_won and checkDraw(local_state_x[board], local_state_o[board]):
         global_state_x |= (1 << board)
         global_state_o |= (1 << board)
 
@@ -299,10 +477,7 @@ def move(global_state_x, global_state_o, local_state_x, local_state_o, currentPl
         
 ### local functions:
 def checkWin(board):
-    for mask in WIN_MASKS:
-        if (board & mask) == mask:
-            return True
-    return False
+    return WIN_TABLE[board]
 
 def checkDraw(board_x, board_o):
     # check if all local boards are full
@@ -320,8 +495,12 @@ def isNotPlayableBoard(global_state_x, global_state_o, board):
     if global_state_x & (1 << board) or global_state_o & (1 << board):
         return True
     return False
-             
+
 ### general functions
+def stonesPlaced(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner):
+    # number of moves played so far
+    return sum(bin(x | o).count("1") for x, o in zip(local_state_x, local_state_o))
+
 def checkValidMove(global_state_x, global_state_o, local_state_x, local_state_o, current_board, board, local_x, local_y):
     # check taht the board is valid 
     if not ((0 <= board <=9) and (current_board == 9 or board == current_board)):
@@ -347,23 +526,61 @@ def getPossibleMoves(global_state_x, global_state_o, local_state_x, local_state_
         return []
     # returns a list of possible moves
     # each move is a tuple (global_x, global_y)
-    possible_moves = []
     if currentBoard == 9:
-        #iterate through all local boards
+        #iterate through all local boards that are still in play
+        played = global_state_x | global_state_o
+        possible_moves = []
         for board in range(9):
-            # check if the board is still in play
-            if isNotPlayableBoard(global_state_x, global_state_o, board):
-                continue
-            for local_x in range(3):
-                for local_y in range(3):
-                    if not isSetOnBoard(local_state_x, local_state_o, board, local_x, local_y):
-                        possible_moves.append((local_x + board % 3 * 3, local_y + board // 3 * 3))
-    else: 
-        for local_x in range(3):
-                for local_y in range(3):
-                    if not isSetOnBoard(local_state_x, local_state_o, currentBoard, local_x, local_y):
-                        possible_moves.append((local_x + currentBoard % 3 * 3, local_y + currentBoard // 3 * 3))
-    return possible_moves
+            if not played & (1 << board):
+                possible_moves.extend(MOVE_TABLE[board][local_state_x[board] | local_state_o[board]])
+        return possible_moves
+    return list(MOVE_TABLE[currentBoard][local_state_x[currentBoard] | local_state_o[currentBoard]])
+
+
+def move_to_action(global_x, global_y):
+    return global_y * 9 + global_x
+
+def action_to_move(action):
+    # returns (global_x, global_y)
+    return action % 9, action // 9
+
+def move_action(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner, action):
+    return move(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner, action % 9, action // 9)
+
+def move_action_hashed(h, global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner, action):
+    return move_hashed(h, global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner, action % 9, action // 9)
+
+def getValidActions(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner):
+    # returns the legal actions (0-80) in the same order as getPossibleMoves
+    if winner is not None:
+        return []
+    if currentBoard == 9:
+        played = global_state_x | global_state_o
+        actions = []
+        for board in range(9):
+            if not played & (1 << board):
+                actions.extend(ACTION_TABLE[board][local_state_x[board] | local_state_o[board]])
+        return actions
+    return list(ACTION_TABLE[currentBoard][local_state_x[currentBoard] | local_state_o[currentBoard]])
+
+def getValidActionBits(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner):
+    # returns the legal actions as an 81-bit int, bit a is set if action a is legal
+    if winner is not None:
+        return 0
+    if currentBoard == 9:
+        played = global_state_x | global_state_o
+        bits = 0
+        for board in range(9):
+            if not played & (1 << board):
+                bits |= ACTION_BITS_TABLE[board][local_state_x[board] | local_state_o[board]]
+        return bits
+    return ACTION_BITS_TABLE[currentBoard][local_state_x[currentBoard] | local_state_o[currentBoard]]
+
+def getValidMask(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner):
+    # returns an 81-long bool array that is True for every legal action
+    mask = np.zeros(NUM_ACTIONS, dtype=bool)
+    mask[getValidActions(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner)] = True
+    return mask
 
 
 def apply_symmetry(bits: int, perm: list[int]) -> int:
@@ -376,59 +593,35 @@ def apply_symmetry(bits: int, perm: list[int]) -> int:
 def generate_all_symmetries(bits: int, map) -> dict[str, int]:
     return [apply_symmetry(bits, perm) for perm in map]
 
+# MASK_SYMMETRIES[mask] holds the 8 symmetries of a 9-bit mask, in get_symmetries order
+# (the same table serves the local boards and the global masks)
+MASK_SYMMETRIES = tuple(tuple(generate_all_symmetries(mask, LOCAL_SYMMETRY_INDICES)) for mask in range(512))
+
 def get_symmetries(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner):
+    # the i-th symmetry moves local board b to SYMMETRY_INDICES[i][b] and transforms its mask with MASK_SYMMETRIES
     symmetries = []
-    
-
-    global_symmetries_x = generate_all_symmetries(global_state_x, SYMMETRY_INDICES) #len = 8
-    global_symmetries_o = generate_all_symmetries(global_state_o, SYMMETRY_INDICES)
-
-    local_symmetries_x = [generate_all_symmetries(board, LOCAL_SYMMETRY_INDICES) for board in local_state_x]
-    local_symmetries_o = [generate_all_symmetries(board, LOCAL_SYMMETRY_INDICES) for board in local_state_o]
-
+    global_symmetries_x = MASK_SYMMETRIES[global_state_x]
+    global_symmetries_o = MASK_SYMMETRIES[global_state_o]
 
     #for each symmetry
     for i in range(8):
-        new_global_state_x = global_symmetries_x[i]
-        new_global_state_o = global_symmetries_o[i]
+        perm = SYMMETRY_INDICES[i]
         new_local_state_x = [0] * 9
         new_local_state_o = [0] * 9
 
         #for each local board
         for j in range(9):
-            new_local_state_x[SYMMETRY_INDICES[i][j]] = local_symmetries_x[j][i]
-            new_local_state_o[SYMMETRY_INDICES[i][j]] = local_symmetries_o[j][i]
-            # new_local_state_o[j] = local_symmetries_o[i][SYMMETRY_INDICES[i][j]]
+            new_local_state_x[perm[j]] = MASK_SYMMETRIES[local_state_x[j]][i]
+            new_local_state_o[perm[j]] = MASK_SYMMETRIES[local_state_o[j]][i]
 
-        new_currentBoard = 9 if 9 == currentBoard else SYMMETRY_INDICES[i][currentBoard]
-        symmetries.append((new_global_state_x, new_global_state_o, new_local_state_x, new_local_state_o, currentPlayer, new_currentBoard, winner))
+        new_currentBoard = 9 if 9 == currentBoard else perm[currentBoard]
+        symmetries.append((global_symmetries_x[i], global_symmetries_o[i], tuple(new_local_state_x), tuple(new_local_state_o), currentPlayer, new_currentBoard, winner))
 
     return symmetries
 
 def flip_arr(arr):
-    # inner flipping
-    internal_flipped = []
-    for perm in range(len(SYMMETRY_INDICES)):
-        internal_rows = []
-        for row in range(len(arr)//9):
-            new_row = [0] * 9
-            for i in range(9):
-                new_row[SYMMETRY_INDICES[perm][i]] = arr[9*row + i]
-            internal_rows.append(new_row)
-        internal_flipped.append(internal_rows)
-    # outer flipping
-    res = []
-    new_arr = [[0] * 9 for _ in range(8)]
-    for perm in range(len(SYMMETRY_INDICES)):
-        for i in range(9):
-            new_arr[perm][SYMMETRY_INDICES[perm][i]] = internal_flipped[perm][i]
-        res.append(sum(new_arr[perm],[]))
-    return res
-        
-
-        
-
-
+    # returns the 8 symmetries of an 81-long policy vector as an (8, 81) array, in get_symmetries order
+    return np.asarray(arr)[SYMMETRY_GATHER]
 
 def stringRep(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner):
     # returns a string representation of the board
@@ -475,6 +668,24 @@ def stringRep(global_state_x, global_state_o, local_state_x, local_state_o, curr
     return board
         
 
+def benchmark_random_games(num_games=10**5):
+    # plays num_games uniformly random games and reports the time taken
+    start = time.time()
+    for _ in range(num_games):
+        game = INITIAL_STATE
+        for i in range(100):
+            possible_moves = getPossibleMoves(*game)
+            if len(possible_moves) == 0:
+                break
+            my_move = random.choice(possible_moves)
+            game = move(*game, my_move[0], my_move[1])
+
+    end = time.time()
+
+    print(f"Time taken: {end - start} seconds")
+    return end - start
+
+
 if __name__ == "__main__":
     arr = [
         1, 0, 0, 0, 0, 0, 0, 0, 0,
@@ -492,21 +703,4 @@ if __name__ == "__main__":
             print(symmetries_result[perm])
             print()
 
-    '''
-    # set start time 
-    start = time.time()
-    for _ in range(10**5):
-        game = copy.deepcopy(INITIAL_STATE)
-        for i in range(100):
-            possible_moves = getPossibleMoves(*game)
-            if len(possible_moves) == 0:
-                # print(f"Game over after {i} moves")
-                break
-            my_move = random.choice(possible_moves)
-            game = move(*game, my_move[0], my_move[1])
-    
-    end = time.time()
-
-    print(f"Time taken: {end - start} seconds")
-    
-    '''
+    # benchmark_random_games(10**5)
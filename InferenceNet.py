@@ -0,0 +1,193 @@
+import copy
+import os
+import random
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+import GameRepresentationFunctional
+from NNet import UltimateTTTNet, encode_states, planes_to_valid_masks
+
+# the single switch: searches (Coach self-play and arena, engineService, InferenceServer) get
+# their network through for_inference / load_network, which use the optimized net if this is set
+OPTIMIZED = True
+
+
+class FusedUltimateTTTNet(nn.Module):
+    """UltimateTTTNet for inference: every batch norm folded into the convolution before it"""
+
+    def __init__(self, nnet):
+        super(FusedUltimateTTTNet, self).__init__()
+        nnet = copy.deepcopy(nnet).cpu().eval()
+        self.conv1 = fuse_conv_bn_eval(nnet.conv1, nnet.bn1)
+        self.conv2 = fuse_conv_bn_eval(nnet.conv2, nnet.bn2)
+        self.conv3 = fuse_conv_bn_eval(nnet.conv3, nnet.bn3)
+        self.policy_conv = fuse_conv_bn_eval(nnet.policy_conv, nnet.policy_bn)
+        self.policy_fc = nnet.policy_fc
+        self.value_conv = fuse_conv_bn_eval(nnet.value_conv, nnet.value_bn)
+        self.value_fc1 = nnet.value_fc1
+        self.value_fc2 = nnet.value_fc2
+
+    def forward(self, x, valid_moves_mask):
+        # same outputs as UltimateTTTNet.forward in eval mode: (B, 81) log policy and (B, 1) value
+        x = F.relu(self.conv1(x))
+        x = F.relu(self.conv2(x))
+        x = F.relu(self.conv3(x))
+
+        p = F.relu(self.policy_conv(x)).view(-1, 2*9*9)
+        p = self.policy_fc(p).masked_fill(~valid_moves_mask, float('-inf'))
+        policy = F.log_softmax(p, dim=1)
+
+        v = F.relu(self.value_conv(x)).view(-1, 9*9)
+        v = F.relu(self.value_fc1(v))
+        value = torch.tanh(self.value_fc2(v))
+        return policy, value
+
+
+class ScriptedNet():
+    """
+    Runs a scripted FusedUltimateTTTNet on the CPU. Has the predict / predict_batch
+    interface of UltimateTTTNet, so it can replace the network in the searches.
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self.device = torch.device("cpu")
+
+    @classmethod
+    def from_nnet(cls, nnet):
+        fused = FusedUltimateTTTNet(nnet).eval()
+        return cls(torch.jit.freeze(torch.jit.script(fused)))
+
+    @classmethod
+    def load(cls, path):
+        return cls(torch.jit.load(path, map_location="cpu"))
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        torch.jit.save(self.module, path)
+
+    def forward(self, x, valid_moves_mask):
+        with torch.inference_mode():
+            return self.module(x, valid_moves_mask)
+
+    def predict(self, state, valid_mask=None):
+        policy, value = self.predict_batch([state], None if valid_mask is None else [valid_mask])
+        return policy[0], value[0].item()
+
+    def predict_batch(self, states=None, valid_masks=None, planes=None):
+        """Same arguments and results as UltimateTTTNet.predict_batch"""
+        with torch.inference_mode():
+            if planes is None:
+                planes = encode_states(states)
+            x = torch.as_tensor(planes)
+            if valid_masks is None:
+                mask = planes_to_valid_masks(x)
+            else:
+                mask = torch.from_numpy(np.asarray(valid_masks, dtype=bool))
+            policy, value = self.module(x, mask)
+            return torch.exp(policy).numpy(), value.view(-1).numpy()
+
+
+def sample_planes(count=256, seed=0):
+    """Encoded planes and legal masks of count positions from random games"""
+    rng = random.Random(seed)
+    states = []
+    while len(states) < count:
+        state = GameRepresentationFunctional.INITIAL_STATE
+        for _ in range(rng.randrange(60)):
+            next_state = GameRepresentationFunctional.move(*state, *rng.choice(GameRepresentationFunctional.getPossibleMoves(*state)))
+            if next_state[-1] is not None:
+                break
+            state = next_state
+        states.append(state)
+    planes = torch.from_numpy(encode_states(states))
+    return planes, planes_to_valid_masks(planes)
+
+def check_equivalence(nnet, optimized, planes=None, masks=None, atol=1e-4):
+    """
+    Compares optimized (a ScriptedNet) with UltimateTTTNet.forward of nnet in eval
+    mode. Returns the largest differences of the policy probabilities and values,
+    raises AssertionError if one is above atol.
+    """
+    if planes is None:
+        planes, masks = sample_planes()
+    was_training = nnet.training
+    nnet.eval()
+    try:
+        with torch.no_grad():
+            policy, value = nnet(planes.to(nnet.device), masks.to(nnet.device))
+    finally:
+        nnet.train(was_training)
+    fused_policy, fused_value = optimized.forward(planes, masks)
+    policy_diff = (torch.exp(policy).cpu() - torch.exp(fused_policy)).abs().max().item()
+    value_diff = (value.cpu() - fused_value).abs().max().item()
+    assert policy_diff <= atol and value_diff <= atol, f"optimized net differs: policy {policy_diff}, value {value_diff}"
+    return policy_diff, value_diff
+
+
+def optimize(nnet, check=True):
+    """Fused, scripted and frozen CPU copy of nnet, checked against nnet.forward"""
+    optimized = ScriptedNet.from_nnet(nnet)
+    if check:
+        check_equivalence(nnet, optimized)
+    return optimized
+
+def export(nnet, path, check=True):
+    """Writes the optimized net of nnet to path (TorchScript) and checks the saved file"""
+    optimized = optimize(nnet, check=False)
+    optimized.save(path)
+    if check:
+        check_equivalence(nnet, ScriptedNet.load(path))
+    return path
+
+def for_inference(nnet, optimized=None):
+    """The network the searches should use: the optimized copy of nnet if the switch is on
+    and nnet runs on the CPU, nnet itself otherwise"""
+    if optimized is None:
+        optimized = OPTIMIZED
+    if not optimized or isinstance(nnet, ScriptedNet) or torch.device(nnet.device).type != "cpu":
+        return nnet
+    return optimize(nnet)
+
+def load_network(path, optimized=None, device=None):
+    """
+    Loads a network for inference from a TorchScript file written by export (.pt)
+    or from a checkpoint of UltimateTTTNet.save_checkpoint, optimized if the switch is on.
+    """
+    if path.endswith(".pt"):
+        return ScriptedNet.load(path)
+    nnet = UltimateTTTNet(device)
+    folder, filename = os.path.split(path)
+    nnet.load_checkpoint(folder or ".", filename)
+    return for_inference(nnet, optimized)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Export a checkpoint as an optimized TorchScript net and compare it with forward().")
+    parser.add_argument("checkpoint", nargs="?", default=None, help="Checkpoint file, a random net if not given")
+    parser.add_argument("--out", default="temp/best.pt")
+    args = parser.parse_args()
+
+    nnet = UltimateTTTNet(torch.device("cpu"))
+    if args.checkpoint:
+        folder, filename = os.path.split(args.checkpoint)
+        nnet.load_checkpoint(folder or ".", filename)
+    export(nnet, args.out)
+    optimized = ScriptedNet.load(args.out)
+    print(f"exported to {args.out}, max difference (policy, value): {check_equivalence(nnet, optimized)}")
+
+    planes, masks = sample_planes(64)
+    for batch in (1, 8, 64):
+        for name, net in (("forward", nnet), ("optimized", optimized)):
+            start = time.perf_counter()
+            for _ in range(200 // batch + 10):
+                net.predict_batch(planes=planes[:batch], valid_masks=masks[:batch].numpy())
+            elapsed = (time.perf_counter() - start) / (200 // batch + 10)
+            print(f"batch {batch:3d} {name:9s} {elapsed * 1000:.2f} ms")
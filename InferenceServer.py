@@ -0,0 +1,312 @@
+import argparse
+import multiprocessing
+import queue
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch
+
+from InferenceNet import for_inference
+from NNet import encode_states, planes_to_valid_masks
+
+# Shared-memory request slots: every worker owns one slot and writes the encoded planes
+# (and legal masks) of up to slotSize positions into it, then puts its slot id on the
+# request queue and waits for its event. The server process gathers the slots of many
+# workers into one batch, runs one forward pass and writes policies and values back.
+
+STATS_WINDOW = 10000  # latencies kept for the percentiles
+
+
+def _layout(numSlots, slotSize):
+    # name -> (shape, dtype) of the arrays in the shared memory block, in order
+    return [
+        ("planes", (numSlots, slotSize, 6, 9, 9), np.float32),
+        ("masks", (numSlots, slotSize, 81), np.bool_),
+        ("policies", (numSlots, slotSize, 81), np.float32),
+        ("values", (numSlots, slotSize), np.float32),
+        ("counts", (numSlots,), np.int64),
+        ("submitted", (numSlots,), np.float64),  # time.monotonic() of the request
+    ]
+
+def _size(numSlots, slotSize):
+    return sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, shape, dtype in _layout(numSlots, slotSize))
+
+def _views(buf, numSlots, slotSize):
+    views = {}
+    offset = 0
+    for name, shape, dtype in _layout(numSlots, slotSize):
+        views[name] = np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return views
+
+
+class InferenceStats:
+    """Batch sizes, queue depth and request latency of the server"""
+
+    def __init__(self):
+        self.batches = 0
+        self.positions = 0
+        self.requests = 0
+        self.histogram = {}  # batch size bucket (powers of two) -> #batches
+        self.queueDepths = []
+        self.latencies = []
+
+    def record(self, size, depth, latencies):
+        self.batches += 1
+        self.positions += size
+        self.requests += len(latencies)
+        bucket = 1 << (size - 1).bit_length()
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+        if depth is not None:
+            self.queueDepths.append(depth)
+        self.latencies.extend(latencies)
+        del self.queueDepths[:-STATS_WINDOW]
+        del self.latencies[:-STATS_WINDOW]
+
+    def snapshot(self):
+        latencies = np.array(self.latencies) * 1000
+        percentiles = np.percentile(latencies, [50, 95, 99]) if len(latencies) else [0.0] * 3
+        return {
+            "batches": self.batches,
+            "positions": self.positions,
+            "requests": self.requests,
+            "meanBatch": self.positions / self.batches if self.batches else 0.0,
+            "batchHistogram": dict(sorted(self.histogram.items())),
+            "meanQueueDepth": float(np.mean(self.queueDepths)) if self.queueDepths else 0.0,
+            "maxQueueDepth": int(max(self.queueDepths)) if self.queueDepths else 0,
+            "latencyMs": {"p50": float(percentiles[0]), "p95": float(percentiles[1]), "p99": float(percentiles[2])},
+        }
+
+
+def _serve(shmName, numSlots, slotSize, requests, events, statsQueue, nnetClass, stateDict, device, maxBatch, maxWait):
+    # main loop of the server process
+    shm = shared_memory.SharedMemory(name=shmName)
+    views = _views(shm.buf, numSlots, slotSize)
+    planes, masks, policies, values, counts, submitted = (views[name] for name, _, _ in _layout(numSlots, slotSize))
+    nnet = nnetClass(device)
+    nnet.load_state_dict(stateDict)
+    nnet.to(nnet.device)
+    nnet.eval()
+    nnet = for_inference(nnet)
+    stats = InferenceStats()
+
+    stopping = False
+    while not stopping:
+        slots = []
+        size = 0
+        item = requests.get()
+        deadline = time.monotonic() + maxWait
+        while True:
+            if item is None:
+                stopping = True
+            elif item == "stats":
+                statsQueue.put(stats.snapshot())
+            else:
+                slots.append(item)
+                size += int(counts[item])
+            if stopping or size >= maxBatch or not slots:
+                break
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+        if not slots:
+            continue
+
+        try:
+            depth = requests.qsize()
+        except NotImplementedError:  # not available on macOS
+            depth = None
+        batch_planes = np.concatenate([planes[slot, :counts[slot]] for slot in slots])
+        batch_masks = np.concatenate([masks[slot, :counts[slot]] for slot in slots])
+        policy, value = nnet.predict_batch(planes=batch_planes, valid_masks=batch_masks)
+
+        start = 0
+        now = time.monotonic()
+        latencies = []
+        for slot in slots:
+            end = start + int(counts[slot])
+            policies[slot, :end - start] = policy[start:end]
+            values[slot, :end - start] = value[start:end]
+            latencies.append(now - submitted[slot])
+            events[slot].set()
+            start = end
+        stats.record(size, depth, latencies)
+
+    del planes, masks, policies, values, counts, submitted, views
+    shm.close()
+
+
+class InferenceClient:
+    """
+    Handle of one worker on the inference server, with the predict / predict_batch
+    interface of UltimateTTTNet so it can replace the network in MCTSNodeLess.
+    Must be used by one thread at a time. Pass it to the worker process as an
+    argument, it attaches to the shared memory on first use.
+    """
+
+    device = "cpu"
+
+    def __init__(self, shmName, slot, numSlots, slotSize, requests, event):
+        self.shmName = shmName
+        self.slot = slot
+        self.numSlots = numSlots
+        self.slotSize = slotSize
+        self.requests = requests
+        self.event = event
+        self.shm = None
+        self.views = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["shm"] = None
+        state["views"] = None
+        return state
+
+    def _attach(self):
+        if self.views is None:
+            self.shm = shared_memory.SharedMemory(name=self.shmName)
+            self.views = _views(self.shm.buf, self.numSlots, self.slotSize)
+
+    def predict(self, state, valid_mask=None):
+        policy, value = self.predict_batch([state], None if valid_mask is None else [valid_mask])
+        return policy[0], float(value[0])
+
+    def predict_batch(self, states=None, valid_masks=None, planes=None):
+        """Same arguments and results as UltimateTTTNet.predict_batch, larger batches than slotSize are split"""
+        self._attach()
+        n = len(states) if planes is None else len(planes)
+        policies = np.empty((n, 81), dtype=np.float32)
+        values = np.empty(n, dtype=np.float32)
+        slot_planes = self.views["planes"][self.slot]
+        slot_masks = self.views["masks"][self.slot]
+        for start in range(0, n, self.slotSize):
+            end = min(n, start + self.slotSize)
+            count = end - start
+            if planes is None:
+                encode_states(states[start:end], out=slot_planes[:count])
+            else:
+                slot_planes[:count] = np.asarray(planes[start:end])
+            if valid_masks is None:
+                slot_masks[:count] = planes_to_valid_masks(slot_planes[:count])
+            else:
+                slot_masks[:count] = np.asarray(valid_masks[start:end], dtype=bool)
+
+            self.views["counts"][self.slot] = count
+            self.views["submitted"][self.slot] = time.monotonic()
+            self.event.clear()
+            self.requests.put(self.slot)
+            self.event.wait()
+            policies[start:end] = self.views["policies"][self.slot, :count]
+            values[start:end] = self.views["values"][self.slot, :count]
+        return policies, values
+
+    def close(self):
+        if self.shm is not None:
+            self.views = None
+            self.shm.close()
+            self.shm = None
+
+
+class InferenceServer:
+    """
+    Runs one copy of the network in its own process for many worker processes.
+
+    numSlots is the number of clients (one per worker), slotSize the most positions
+    one request can carry (e.g. the parallelLeaves of MCTSNodeLess). Requests are
+    gathered into batches of up to maxBatch positions, waiting at most maxWait
+    seconds for more requests once the first one arrived.
+
+    Workers should be started from the same multiprocessing context (self.context).
+    """
+
+    def __init__(self, nnet, numSlots, slotSize=8, maxBatch=256, maxWait=0.002, device=None):
+        self.context = multiprocessing.get_context("spawn")
+        self.numSlots = numSlots
+        self.slotSize = slotSize
+        self.shm = shared_memory.SharedMemory(create=True, size=_size(numSlots, slotSize))
+        self.requests = self.context.Queue()
+        self.events = [self.context.Event() for _ in range(numSlots)]
+        self.statsQueue = self.context.Queue()
+        state_dict = {name: tensor.cpu() for name, tensor in nnet.state_dict().items()}
+        device = device if device is not None else nnet.device
+        self.process = self.context.Process(
+            target=_serve,
+            args=(self.shm.name, numSlots, slotSize, self.requests, self.events, self.statsQueue,
+                  nnet.__class__, state_dict, torch.device(device), maxBatch, maxWait),
+            name="InferenceServer",
+            daemon=True,
+        )
+        self.process.start()
+
+    def client(self, slot):
+        """Handle for the worker that owns slot (0 <= slot < numSlots)"""
+        return InferenceClient(self.shm.name, slot, self.numSlots, self.slotSize, self.requests, self.events[slot])
+
+    def stats(self, timeout=10):
+        """Batch size histogram, queue depth and latency percentiles (ms) of the server"""
+        self.requests.put("stats")
+        return self.statsQueue.get(timeout=timeout)
+
+    def close(self):
+        self.requests.put(None)
+        self.process.join()
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _self_play_worker(client, games, numMCTSSims, parallelLeaves, results, evalCache=None):
+    # plays games of self-play with MCTSNodeLess on the inference server and reports the moves played
+    import GameRepresentationFunctional
+    from MCTS_NEW import MCTSNodeLess
+
+    moves = 0
+    for _ in range(games):
+        mcts = MCTSNodeLess(client, numMCTSSims, parallelLeaves=parallelLeaves, evalCache=evalCache)
+        state = GameRepresentationFunctional.INITIAL_STATE
+        while state[-1] is None:
+            pi = mcts.getActionProb(state, temp=1)
+            state = GameRepresentationFunctional.move_action(*state, int(np.random.choice(len(pi), p=pi)))
+            moves += 1
+    client.close()
+    if evalCache is not None:
+        evalCache.close()
+    results.put(moves)
+
+
+if __name__ == "__main__":
+    from EvaluationCache import SharedEvaluationCache
+    from NNet import UltimateTTTNet
+
+    parser = argparse.ArgumentParser(description="Self-play throughput of worker processes sharing one inference server.")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--games", type=int, default=1, help="Games per worker")
+    parser.add_argument("--sims", type=int, default=50)
+    parser.add_argument("--parallel-leaves", type=int, default=8)
+    parser.add_argument("--max-batch", type=int, default=256)
+    parser.add_argument("--max-wait", type=float, default=0.002)
+    parser.add_argument("--cache", type=int, default=0, help="Entries of an evaluation cache shared by the workers, 0 for none")
+    args = parser.parse_args()
+
+    server = InferenceServer(UltimateTTTNet(), args.workers, args.parallel_leaves, args.max_batch, args.max_wait)
+    cache = SharedEvaluationCache(args.cache, context=server.context) if args.cache else None
+    results = server.context.Queue()
+    start = time.time()
+    workers = [server.context.Process(target=_self_play_worker, args=(server.client(i), args.games, args.sims, args.parallel_leaves, results, cache))
+               for i in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    moves = sum(results.get() for _ in workers)
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    print(f"{args.workers * args.games} games, {moves} moves in {elapsed:.1f}s, {moves / elapsed:.1f} moves/s")
+    print(server.stats())
+    if cache is not None:
+        print(cache.stats())
+        cache.close()
+    server.close()
@@ -1,38 +1,49 @@
-import copy
 import numpy as np
 import random
 import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
 import GameRepresentationFunctional as GameRepresentation
 
 # state = (global_state x, global state o, local state x, local state o, currentplayer, currentboard, winner)
 
 class MCTSNode:
-    def __init__(self, state, nnet, parent=None):
-        self.state = state        # Game state or environment state 
+    """Search tree node. Nodes hold no state, the state of a node is rebuilt by applying
+    the actions on the path from the root (see MCTS.select), which keeps nodes small.
+    The visits and values of the children are kept in the stats array of their parent
+    (allocated on the first expansion), so UCT is computed for all children at once."""
+    __slots__ = ("parent", "action", "index", "children", "visits", "untried", "stats")
+
+    def __init__(self, action, parent, untried, index=0):
         self.parent = parent        # Parent node
+        self.action = action        # Action (0-80) that led to this node, None for the root
+        self.index = index          # Position of this node in the children of its parent
         self.children = []         # Child nodes
         self.visits = 0            # Number of times node was visited
-        self.value = 0            # Accumulated value from simulations
-        self.untried_actions = GameRepresentation.getPossibleMoves(*state)  # Actions not yet expanded, move array [(0,1)]
-        self.action = None         # Action that led to this node
-        self.nnet = nnet
-        
+        self.untried = untried     # Bitmask of the actions not yet expanded, bit a for action a
+        self.stats = None          # (2, #legal actions): visits and accumulated values of the children
+
+    @property
+    def value(self):
+        """Accumulated value from simulations"""
+        return self.parent.stats[1, self.index] if self.parent is not None else 0
+
     def is_fully_expanded(self):
-        return len(self.untried_actions) == 0
-    
-    def is_terminal(self):
-        """Check if the node represents a terminal state"""
-        return self.state[-1] != None 
-        
-    def expand(self):
-        """Expand a node by creating a new child"""
-        action = self.untried_actions.pop()
-        next_state = copy.deepcopy(self.state)
-        next_state = GameRepresentation.move(*next_state, *action) 
-        child_node = MCTSNode(next_state, parent=self, nnet=self.nnet)
-        child_node.action = action
+        return not self.untried
+
+    def expand(self, state):
+        """Expand a node by creating a new child, state is the state of this node.
+        Returns the child and its state."""
+        if self.stats is None:
+            self.stats = np.zeros((2, bin(self.untried).count("1")))
+        action = (self.untried & -self.untried).bit_length() - 1
+        self.untried &= self.untried - 1
+        next_state = GameRepresentation.move_action(*state, action)
+        child_node = MCTSNode(action, self, GameRepresentation.getValidActionBits(*next_state), len(self.children))
         self.children.append(child_node)
-        return child_node
+        return child_node, next_state
     
     def getUCB(self, exploration_weight=1.4):
         """Calculate Upper Confidence Bound (UCB) for this node"""
@@ -46,103 +57,169 @@ class MCTSNode:
         return self.value / self.visits + exploration_weight * math.sqrt(math.log(top_level.visits) / self.visits)
     
     def best_child(self, exploration_weight=1.4):
-        """Select the best child according to UCT (Upper Confidence Bound for Trees)"""
-        weights = np.array([child.getUCB(exploration_weight) for child in self.children])
-        return self.children[np.argmax(weights)]
-    
-    def rollout(self):
-        """Perform a random simulation from this node's state"""
-        current_state = copy.deepcopy(self.state)
-        while current_state[-1] is None:  # Implement is_terminal for your problem
-            valid_moves = GameRepresentation.getPossibleMoves(*current_state)
-           # Get policy probabilities ONLY for valid moves
-            chosen_move = None
-            if self.nnet != None:
-                policy_probs, _ = self.nnet.predict(current_state, valid_moves)
-
-                # Filter probabilities for only valid moves
-                valid_probs = []
-                valid_indices = []
-                for x, y in valid_moves:
-                    index = y * 9 + x  # Convert (x,y) to flat index
-                    valid_probs.append(policy_probs[index])
-                    valid_indices.append(index)
-            
-                # Normalize the probabilities (sum to 1)
-                prob_sum = sum(valid_probs)
-                if prob_sum <= 0:  # Handle edge case
-                    valid_probs = [1/len(valid_moves)] * len(valid_moves)
-                else:
-                    valid_probs = [p/prob_sum for p in valid_probs]
-                
-                # Choose action by weighted random selection
-                chosen_idx = random.choices(range(len(valid_moves)), weights=valid_probs, k=1)[0]
-                chosen_move = valid_moves[chosen_idx]
-            else: 
-                chosen_move = random.choice(valid_moves)
-
-            current_state = GameRepresentation.move(*current_state, *chosen_move)
-        return get_reward(current_state) 
+        """Select the best child according to UCT (Upper Confidence Bound for Trees).
+        Only called on fully expanded nodes, every child was visited at least once."""
+        visits, values = self.stats
+        ucb = np.sqrt(math.log(self.visits) / visits)
+        ucb *= exploration_weight
+        ucb += values / visits
+        return self.children[ucb.argmax()]
     
     def backpropagate(self, reward):
-        """Backpropagate the simulation result"""
-        self.visits += 1
-        self.value += reward
-        if self.parent:
-            self.parent.backpropagate(1 - reward)
+        """Backpropagate the simulation result, reward is in [0, 1] for the player who moved into this node"""
+        node = self
+        while node is not None:
+            node.visits += 1
+            parent = node.parent
+            if parent is not None:
+                stats = parent.stats
+                stats[0, node.index] += 1
+                stats[1, node.index] += reward
+            reward = 1 - reward
+            node = parent
+
+def rollout(state, nnet=None):
+    """Perform a random simulation from state"""
+    current_state = state
+    while current_state[-1] is None:  # Implement is_terminal for your problem
+        valid_moves = GameRepresentation.getPossibleMoves(*current_state)
+       # Get policy probabilities ONLY for valid moves
+        chosen_move = None
+        if nnet != None:
+            policy_probs, _ = nnet.predict(current_state, GameRepresentation.getValidMask(*current_state))
+
+            # Filter probabilities for only valid moves
+            valid_probs = []
+            for x, y in valid_moves:
+                valid_probs.append(policy_probs[GameRepresentation.move_to_action(x, y)])
+        
+            # Normalize the probabilities (sum to 1)
+            prob_sum = sum(valid_probs)
+            if prob_sum <= 0:  # Handle edge case
+                valid_probs = [1/len(valid_moves)] * len(valid_moves)
+            else:
+                valid_probs = [p/prob_sum for p in valid_probs]
+            
+            # Choose action by weighted random selection
+            chosen_idx = random.choices(range(len(valid_moves)), weights=valid_probs, k=1)[0]
+            chosen_move = valid_moves[chosen_idx]
+        else: 
+            chosen_move = random.choice(valid_moves)
+
+        current_state = GameRepresentation.move(*current_state, *chosen_move)
+    return get_reward(current_state) 
 
 def get_reward(state):
-    """Get the reward for the current state"""
-    if state[-1] == "D":
-        return 0
+    """Get the reward of a finished game for x: 1 for a win, 0.5 for a draw, 0 for a loss"""
+    if state[-1] == 0:
+        return 0.5
     elif state[-1] == 1:
         return 1
     else:
-        return -1
-        
+        return 0
+
 
 class MCTS:
     def __init__(self, initial_state, iteration_limit=1000, nnet=None):
-        self.root = MCTSNode(initial_state, nnet)
+        self.state = initial_state  # state of the root, the states below it are rebuilt while descending
+        self.root = self.new_node(initial_state)
         self.iteration_limit = iteration_limit
         self.nnet = nnet
-    def search(self):
-        """Run the MCTS algorithm"""
-        for _ in range(self.iteration_limit):
-            node = self.select(self.root)
-            reward = self.simulate(node)
-            node.backpropagate(reward)
+        self.reused_visits = 0  # visits of the root inherited from earlier searches
+        self.iterations = 0  # iterations run by the last search
+    def search(self, deadline=None, iteration_limit=None, stop=None):
+        """Run the MCTS algorithm for iteration_limit iterations (default self.iteration_limit)
+        or till the time.monotonic() deadline, whichever comes first. At least one iteration
+        runs even if the deadline already passed, so a best action is always found. The search
+        is cancelled early once the threading.Event stop is set. Stopping early is safe, every
+        finished iteration is already backpropagated."""
+        if iteration_limit is None:
+            iteration_limit = self.iteration_limit
+        iterations = 0
+        while iterations < iteration_limit and (iterations == 0 or deadline is None or time.monotonic() < deadline) \
+                and (stop is None or not stop.is_set()):
+            node, state = self.select()
+            reward = self.simulate(state)
+            # the player who moved into node, it is still the player to move in a finished game
+            if state[4] == (state[-1] is not None):
+                node.backpropagate(reward)
+            else:
+                node.backpropagate(1 - reward)
+            iterations += 1
+        self.iterations = iterations
         return self.get_best_action()
     
-    def select(self, node):
-        """Select a node to expand"""
-        while not node.is_terminal():
+    @staticmethod
+    def new_node(state, action=None, parent=None):
+        return MCTSNode(action, parent, GameRepresentation.getValidActionBits(*state))
+
+    def is_terminal(self):
+        return self.state[-1] is not None
+
+    def select(self):
+        """Select a node to expand, returns it with its state"""
+        node, state = self.root, self.state
+        while state[-1] is None:
             if node.is_fully_expanded():
                 node = node.best_child()
+                state = GameRepresentation.move_action(*state, node.action)
             else:
-                return node.expand()
-        return node
+                return node.expand(state)
+        return node, state
     
-    def simulate(self, node):
-        """Run a simulation from the given node"""
-        if node.is_terminal():
-            return get_reward(node.state)
-        return node.rollout()
+    def simulate(self, state):
+        """Run a simulation from the given state"""
+        if state[-1] is not None:
+            return get_reward(state)
+        return rollout(state, self.nnet)
     
     def get_best_action(self):
-        """Get the best action based on current search results"""
+        """Get the best action (x, y) based on current search results"""
         if not self.root.children:
             return None
-        return max(self.root.children, key=lambda x: x.visits).action
+        return GameRepresentation.action_to_move(max(self.root.children, key=lambda x: x.visits).action)
     
+    def get_visit_counts(self):
+        """Visits of the children of the root"""
+        return [child.visits for child in self.root.children]
+
     def update_root(self, action):
-        """Advance the tree to the child node corresponding to the taken action"""
+        """Advance the tree to the child node corresponding to the taken action (ours or the opponent's)
+        and return the number of visits it keeps. An unexplored action starts a new tree."""
+        state = GameRepresentation.move(*self.state, *action)
+        action = GameRepresentation.move_to_action(*action)
         for child in self.root.children:
             if child.action == action:
-                self.root = child
-                self.root.parent = None
-                return
-        raise ValueError("Action not found in root's children")
+                self.set_root(child, state)
+                return self.reused_visits
+        self.set_root(self.new_node(state), state)
+        return self.reused_visits
+
+    def update_root_state(self, state, max_depth=2):
+        """Advance the tree to the node of state, looking up to max_depth plies below the root
+        (our move and the opponent's reply). Starts a new tree if the state was not explored."""
+        if self.state == state:
+            return self.reused_visits
+        level = [(self.root, self.state)]
+        for _ in range(max_depth):
+            level = [(child, GameRepresentation.move_action(*node_state, child.action))
+                     for node, node_state in level for child in node.children]
+            for node, node_state in level:
+                if node_state == state:
+                    self.set_root(node, state)
+                    return self.reused_visits
+        self.set_root(self.new_node(state), state)
+        return self.reused_visits
+
+    def set_root(self, node, state):
+        """Make node (of state) the root and drop the rest of the old tree"""
+        old_root = self.root
+        self.root = node
+        self.state = state
+        self.root.parent = None
+        if old_root is not node:
+            old_root.children = []
+        self.reused_visits = node.visits
     
     def get_action_probabilities(self, num_samples=100, temp=1):
         """Get action probabilities based on visit counts"""
@@ -166,4 +243,119 @@ class MCTS:
             connector = "└── " if i == len(children) - 1 else "├── "
             print(prefix + connector + str(str(child.value) + "/" + str(child.visits)))
             extension = "    " if i == len(children) - 1 else "│   "
-            #self.print_tree(child, prefix + extension)
\ No newline at end of file
+            #self.print_tree(child, prefix + extension)
+
+# root parallelization: every worker process searches the root on its own, the root statistics are merged
+
+_worker_nnet = None
+_worker_cancel = None
+
+def _init_root_worker(nnet, cancel):
+    global _worker_nnet, _worker_cancel
+    if nnet is not None:
+        from InferenceNet import for_inference
+        nnet = for_inference(nnet)
+    _worker_nnet = nnet
+    _worker_cancel = cancel
+
+def _root_search(state, iteration_limit, seed, deadline):
+    """Runs one independent search of state in a worker and returns (action, visits, value) of the root children"""
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+    mcts = MCTS(state, iteration_limit, _worker_nnet)
+    mcts.search(deadline=deadline, stop=_worker_cancel)
+    return mcts.iterations, [(GameRepresentation.action_to_move(child.action), child.visits, child.value) for child in mcts.root.children]
+
+
+class RootParallelMCTS:
+    """Root-parallel MCTS: workers processes search the same position with different seeds
+    and the visits and values of the root children are summed before the move is picked.
+    Same interface as MCTS, but no tree is kept between moves. The root statistics add up over
+    all searches of the same root, like the visits of a kept tree. The process pool is started
+    once and reused for every move, close() shuts it down."""
+
+    def __init__(self, initial_state, iteration_limit=1000, nnet=None, workers=None, seed=None):
+        self.state = initial_state
+        self.iteration_limit = iteration_limit
+        self.workers = workers or os.cpu_count()
+        # set to cancel the searches of all workers
+        self.cancel = multiprocessing.Event()
+        self.pool = ProcessPoolExecutor(self.workers, initializer=_init_root_worker, initargs=(nnet, self.cancel))
+        self.rng = random.Random(seed)
+        self.stats = {}  # action -> [visits, value] of all searches of the root
+        self.iterations = 0  # iterations run by the last search
+        self.reused_visits = 0
+
+    def search(self, deadline=None, iteration_limit=None, stop=None):
+        """Splits iteration_limit (default self.iteration_limit) over the workers, every worker
+        stops at the time.monotonic() deadline or when the threading.Event stop is set.
+        The root children statistics of the workers are added to those of earlier searches."""
+        if iteration_limit is None:
+            iteration_limit = self.iteration_limit
+        per_worker = -(-iteration_limit // self.workers)
+        self.cancel.clear()
+        futures = [self.pool.submit(_root_search, self.state, per_worker, self.rng.getrandbits(63), deadline)
+                   for _ in range(self.workers)]
+        pending = set(futures)
+        while pending:
+            _, pending = wait(pending, timeout=0.01)
+            if stop is not None and stop.is_set():
+                self.cancel.set()
+
+        self.iterations = 0
+        for future in futures:
+            iterations, children = future.result()
+            self.iterations += iterations
+            for action, visits, value in children:
+                merged = self.stats.setdefault(action, [0, 0])
+                merged[0] += visits
+                merged[1] += value
+        return self.get_best_action()
+
+    def get_best_action(self):
+        if not self.stats:
+            return None
+        # most visits, ties broken by the mean value
+        return max(self.stats, key=lambda action: (self.stats[action][0], self.stats[action][1] / max(1, self.stats[action][0])))
+
+    def get_visit_counts(self):
+        return [visits for visits, _ in self.stats.values()]
+
+    def is_terminal(self):
+        return self.state[-1] is not None
+
+    def update_root(self, action):
+        self.state = GameRepresentation.move(*self.state, *action)
+        self.stats = {}
+        return 0
+
+    def update_root_state(self, state, max_depth=2):
+        self.state = state
+        self.stats = {}
+        return 0
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class _TreeOnlyMCTS(MCTS):
+    # fixed rollout result, so the benchmark measures selection, expansion and backpropagation only
+    def simulate(self, state):
+        return get_reward(state) if state[-1] is not None else 0.5
+
+def benchmark_search(iteration_limit=10000, repeats=3, seed=0, tree_only=False):
+    # iterations per second of a best_move sized search from the initial position, best of repeats
+    best = float('inf')
+    for i in range(repeats):
+        random.seed(seed + i)
+        mcts = (_TreeOnlyMCTS if tree_only else MCTS)(GameRepresentation.INITIAL_STATE, iteration_limit)
+        start = time.perf_counter()
+        mcts.search()
+        best = min(best, time.perf_counter() - start)
+    print(f"{'tree only: ' if tree_only else ''}{iteration_limit} iterations in {best:.3f} seconds, {iteration_limit / best:.0f} iterations/s")
+    return iteration_limit / best
+
+
+if __name__ == "__main__":
+    benchmark_search()
+    benchmark_search(tree_only=True)
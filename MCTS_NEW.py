@@ -1,12 +1,10 @@
-import copy
 import logging
-import math
+import time
 
 import numpy as np
 
 import GameRepresentationFunctional
-
-EPS = 1e-8
+from NodeTable import NodeTable
 
 log = logging.getLogger(__name__)
 
@@ -16,39 +14,139 @@ class MCTSNodeLess():
     This class handles the MCTS tree.
     """
 
-    def __init__(self, nnet, numMCTSSims=25):
+    def __init__(self, nnet, numMCTSSims=25, useSymmetries=True, cpuct=1, parallelLeaves=1, virtualLoss=1, reuseTree=True,
+                 maxNodes=None, maxBytes=None, evalCache=None):
         self.nnet = nnet
         self.device = nnet.device
         self.numMCTSSims = numMCTSSims
-        self.Qsa = {}  # stores Q values for s,a (as defined in the paper)
-        self.Nsa = {}  # stores #times edge s,a was visited
-        self.Ns = {}  # stores #times board s was visited
-        self.Ps = {}  # stores initial policy (returned by neural net)
-
-        self.Es = {}  # stores game.getGameEnded ended for board s
-        self.Vs = {}  # stores game.getValidMoves for board s
+        self.cpuct = cpuct
+        # number of leaves collected with virtual loss and evaluated in one batched forward pass
+        self.parallelLeaves = parallelLeaves
+        self.virtualLoss = virtualLoss
+        # with symmetries, states are keyed by their canonical hash (minimum over the 8 symmetries)
+        # and the node statistics hold actions in the canonical frame of the state
+        if useSymmetries:
+            self.zobristTable = GameRepresentationFunctional.SYMMETRY_ZOBRIST_TABLE
+            self.symmetryCount = 8
+        else:
+            self.zobristTable = GameRepresentationFunctional.ZOBRIST_TABLE
+            self.symmetryCount = 1
+        # stores N, W (Q = W / N), P and the legal actions of every expanded state
+        # bounded by maxNodes / maxBytes, evicting old and rarely visited nodes but never the root
+        self.nodes = NodeTable(maxNodes=maxNodes, maxBytes=maxBytes)
+        # with reuseTree, every new position becomes the root and the nodes it cannot reach are dropped
+        self.reuseTree = reuseTree
+        self.rootKey = None
+        self.reusedVisits = 0  # visits of the root that were inherited from earlier searches
+        # evaluations shared with other searches of the same model (EvaluationCache), keyed like the nodes
+        if evalCache is not None and evalCache.symmetric != useSymmetries:
+            raise ValueError("evalCache and the search have to agree on useSymmetries")
+        self.evalCache = evalCache
 
-    def getActionProb(self, canonicalBoard, temp=1):
+    def getActionProb(self, canonicalBoard, temp=1, deadline=None, numMCTSSims=None, stop=None):
         """
         This function performs numMCTSSims simulations of MCTS starting from
-        canonicalBoard.
+        canonicalBoard, or fewer if the time.monotonic() deadline passes first
+        or the threading.Event stop is set.
+
+        Returns:
+            probs: a policy vector over the 81 actions where the probability of
+                   the ith action is proportional to Nsa[(s,a)]**(1./temp)
+        """
+        hs = GameRepresentationFunctional.symmetric_zobrists(*canonicalBoard, table=self.zobristTable)
+        if self.reuseTree:
+            self.update_root(canonicalBoard, hs)
+        else:
+            self.rootKey = GameRepresentationFunctional.canonical_from_zobrists(hs, self.symmetryCount)[0]
+            self.nodes.new_generation()
+        self.searchUntil(canonicalBoard, deadline, numMCTSSims, hs, stop)
+
+        return self.getRootProb(hs, temp)
+
+    def searchUntil(self, canonicalBoard, deadline=None, numMCTSSims=None, hs=None, stop=None):
+        """
+        Anytime search: runs simulations from canonicalBoard till numMCTSSims
+        (default self.numMCTSSims) are done or the time.monotonic() deadline
+        passed, whichever comes first, or till the threading.Event stop is set.
+        Both are checked between batches of parallelLeaves simulations. The
+        root must already be set, see getActionProb.
+
+        Returns:
+            the number of simulations that were run
+        """
+        if hs is None:
+            hs = GameRepresentationFunctional.symmetric_zobrists(*canonicalBoard, table=self.zobristTable)
+        if numMCTSSims is None:
+            numMCTSSims = self.numMCTSSims
+        root_key = GameRepresentationFunctional.canonical_from_zobrists(hs, self.symmetryCount)[0]
+        sims = 0
+        while sims < numMCTSSims and (deadline is None or time.monotonic() < deadline) \
+                and (stop is None or not stop.is_set()):
+            k = min(self.parallelLeaves, numMCTSSims - sims)
+            if k == 1 or self.nodes.get(root_key) < 0:
+                # a fresh or evicted root is expanded alone, a batch would send all k leaves to it
+                k = 1
+                self.search(canonicalBoard, hs)
+            else:
+                self.searchBatch(canonicalBoard, k, hs)
+            sims += k
+        return sims
+
+    def update_root(self, board, hs=None):
+        """
+        Makes board the root of the tree after a move was played (ours or the
+        opponent's). The statistics of its subtree are kept, every node that
+        is not reachable from it is dropped.
 
         Returns:
-            probs: a policy vector where the probability of the ith action is
-                   proportional to Nsa[(s,a)]**(1./temp)
+            the number of visits of the new root inherited from earlier searches
         """
-        for i in range(self.numMCTSSims):
-            self.search(copy.deepcopy(canonicalBoard))
-
-        s = GameRepresentationFunctional.zobrist(*canonicalBoard)
-    
-        # Initialize counts with zeros
-        counts = [0] * 81
-        
-        # Populate counts from Nsa
-        for (state_action, count) in self.Nsa.items():
-            if state_action[0] == s:
-                counts[state_action[1]] = count
+        if hs is None:
+            hs = GameRepresentationFunctional.symmetric_zobrists(*board, table=self.zobristTable)
+        root_key = GameRepresentationFunctional.canonical_from_zobrists(hs, self.symmetryCount)[0]
+        if root_key == self.rootKey:
+            return self.reusedVisits
+        self.rootKey = root_key
+        self.nodes.new_generation()
+
+        # collect the nodes reachable over visited edges (every expanded node was reached over one)
+        keep = set()
+        stack = [(board, hs)]
+        while stack:
+            board, hs = stack.pop()
+            s, sym = GameRepresentationFunctional.canonical_from_zobrists(hs, self.symmetryCount)
+            node = self.nodes.get(s)
+            if node < 0 or node in keep:
+                continue
+            keep.add(node)
+            for a in np.flatnonzero(self.nodes.N[node] > 0):
+                board_a = GameRepresentationFunctional.INVERSE_ACTION_SYMMETRIES[sym][a]
+                next_board = GameRepresentationFunctional.move_action(*board, board_a)
+                if next_board[-1] is None:
+                    stack.append((next_board, GameRepresentationFunctional.symmetric_zobrists_update(hs, board, next_board, board_a % 9, board_a // 9, self.zobristTable)))
+        self.nodes.retain(keep)
+
+        root = self.nodes.get(root_key)
+        self.reusedVisits = int(self.nodes.Ns[root]) if root >= 0 else 0
+        return self.reusedVisits
+
+    def stats(self):
+        """Size, hit rate and evictions of the node table, the visits reused at the root and the evaluation cache"""
+        stats = dict(self.nodes.stats(), reusedVisits=self.reusedVisits)
+        if self.evalCache is not None:
+            stats["evalCache"] = self.evalCache.stats()
+        return stats
+
+    def getRootCounts(self, hs):
+        # map the visit counts from the canonical frame back to the actions of the board, all 0 for an unvisited root
+        s, sym = GameRepresentationFunctional.canonical_from_zobrists(hs, self.symmetryCount)
+        node = self.nodes.get(s)
+        if node < 0:
+            return np.zeros(GameRepresentationFunctional.NUM_ACTIONS)
+        return self.nodes.N[node][GameRepresentationFunctional.INVERSE_SYMMETRY_GATHER[sym]].astype(np.float64)
+
+    def getRootProb(self, hs, temp=1):
+        counts = self.getRootCounts(hs)
 
         if temp == 0:
             bestAs = np.array(np.argwhere(counts == np.max(counts))).flatten()
@@ -62,74 +160,152 @@ class MCTSNodeLess():
         probs = [x / counts_sum for x in counts]
         return probs
 
-    def search(self, canonicalBoard):
+    def search(self, canonicalBoard, hs=None):
         """
-        This function performs one iteration of MCTS. It is recursively called
-        till a leaf node is found. The action chosen at each node is one that
-        has the maximum upper confidence bound as in the paper.
+        This function performs one iteration of MCTS. It descends the tree till
+        a leaf node is found. The action chosen at each node is one that has the
+        maximum upper confidence bound as in the paper, computed for all 81
+        actions of the node at once.
 
         Once a leaf node is found, the neural network is called to return an
         initial policy P and a value v for the state. This value is propagated
         up the search path. In case the leaf node is a terminal state, the
-        outcome is propagated up the search path. The values of Ns, Nsa, Qsa are
+        outcome is propagated up the search path. The values of Ns, N and W are
         updated.
 
         NOTE: the return values are the negative of the value of the current
         state. This is done since v is in [-1,1] and if v is the value of a
         state for the current player, then its value is -v for the other player.
 
+        hs are the zobrist hashes of the symmetries of canonicalBoard. They are
+        computed once at the root and updated incrementally while descending.
+        The state key s is the smallest of them.
+
         Returns:
             v: the negative of the value of the current canonicalBoard
         """
+        if hs is None:
+            hs = GameRepresentationFunctional.symmetric_zobrists(*canonicalBoard, table=self.zobristTable)
+        self.nodes.reserve(1, (self.rootKey,))
 
-        s = GameRepresentationFunctional.zobrist(*canonicalBoard)
+        path, board, s, sym, v = self.descend(canonicalBoard, hs)
+        if v is None:
+            v = -self.expand(board, s, sym)
+        return self.backup(path, v)
 
-        if s not in self.Es:
-            self.Es[s] = canonicalBoard[-1]
-        if self.Es[s] != None:
-            # terminal node
-            return -self.Es[s]
+    def searchBatch(self, canonicalBoard, k, hs=None):
+        """
+        Performs k iterations of MCTS at once. The k descents run one after
+        another, every visited edge gets a virtual loss so the following
+        descents spread over different paths. The reached leaves are evaluated
+        in one batched forward pass, then the real values replace the virtual
+        losses along every path.
+        """
+        if hs is None:
+            hs = GameRepresentationFunctional.symmetric_zobrists(*canonicalBoard, table=self.zobristTable)
+        self.nodes.reserve(k, (self.rootKey,))
 
-        if s not in self.Ps:
-            # leaf node
-            valids = GameRepresentationFunctional.getPossibleMoves(*canonicalBoard)
-            self.Ps[s], v = self.nnet.predict(canonicalBoard, valids)
-            sum_Ps_s = np.sum(self.Ps[s])
-            self.Ps[s] /= sum_Ps_s  # renormalize
+        descents = []
+        pending = {}  # s -> (board, sym) of the leaves to evaluate
+        for _ in range(k):
+            path, board, s, sym, v = self.descend(canonicalBoard, hs, self.virtualLoss)
+            if v is None and s not in pending:
+                pending[s] = (board, sym)
+            descents.append((path, s, v))
 
-            self.Vs[s] = valids
-            self.Ns[s] = 0
-            return -v
+        values = self.expandBatch(pending) if pending else {}
+        for path, s, v in descents:
+            if v is None:
+                v = -values[s]
+            self.backup(path, v, self.virtualLoss)
 
-        valids = self.Vs[s]
-        cur_best = -float('inf')
-        best_act = -1
+    def descend(self, board, hs, virtualLoss=0):
+        """
+        Follows the highest upper confidence bound from board till a leaf or a
+        terminal state.
 
-        # pick the action with the highest upper confidence bound
-        for a in range(len(valids)):
-            if valids[a]:
-                if (s, a) in self.Qsa:
-                    u = self.Qsa[(s, a)] + 1 * self.Ps[s][a] * math.sqrt(self.Ns[s]) / (
-                            1 + self.Nsa[(s, a)])
-                else:
-                    u = 1 * self.Ps[s][a] * math.sqrt(self.Ns[s] + EPS)  # Q = 0 ?
+        Returns:
+            path: the visited (node, action) edges
+            board, s, sym: the reached state, its key and symmetry
+            v: the value of a terminal state for the player who moved into it,
+               None if the state is a leaf that still has to be evaluated
+        """
+        path = []
+        while True:
+            if board[-1] is not None:
+                # terminal node, the player who made the last move won (or drew)
+                return path, board, None, None, abs(board[-1])
 
-                if u > cur_best:
-                    cur_best = u
-                    best_act = a
+            s, sym = GameRepresentationFunctional.canonical_from_zobrists(hs, self.symmetryCount)
+            node = self.nodes.get(s)
+            if node < 0:
+                # leaf node
+                return path, board, s, sym, None
 
-        a = best_act
-        next_s = GameRepresentationFunctional.move(*(copy.deepcopy(canonicalBoard)), *valids[a])
+            a = self.nodes.select(node, self.cpuct)
+            if virtualLoss:
+                self.nodes.add_virtual_loss(node, a, virtualLoss)
+            path.append((node, a))
+            board_a = GameRepresentationFunctional.INVERSE_ACTION_SYMMETRIES[sym][a]
+            next_board = GameRepresentationFunctional.move_action(*board, board_a)
+            hs = GameRepresentationFunctional.symmetric_zobrists_update(hs, board, next_board, board_a % 9, board_a // 9, self.zobristTable)
+            board = next_board
 
-        v = self.search(next_s)
+    def backup(self, path, v, virtualLoss=0):
+        """Propagates v up the path, flipping its sign at every level, and returns the root value"""
+        for node, a in reversed(path):
+            if virtualLoss:
+                self.nodes.revert_virtual_loss(node, a, v, virtualLoss)
+            else:
+                self.nodes.update(node, a, v)
+            v = -v
+        return v
 
-        if (s, a) in self.Qsa:
-            self.Qsa[(s, a)] = (self.Nsa[(s, a)] * self.Qsa[(s, a)] + v) / (self.Nsa[(s, a)] + 1)
-            self.Nsa[(s, a)] += 1
+    def expand(self, board, s, sym):
+        """Evaluates board with the network (or takes it from the evaluation cache), stores it as node s and returns its value"""
+        valids = GameRepresentationFunctional.getValidMask(*board)
+        to_canonical = GameRepresentationFunctional.SYMMETRY_GATHER[sym]
+        cached = self.evalCache.get(s) if self.evalCache is not None else None
+        if cached is not None:
+            ps, v = cached
+            self.nodes.add(s, ps, valids[to_canonical])
+            return v
 
-        else:
-            self.Qsa[(s, a)] = v
-            self.Nsa[(s, a)] = 1
+        ps, v = self.nnet.predict(board, valids)
+        ps = ps / np.sum(ps)  # renormalize
+
+        # store policy and legal actions in the canonical frame
+        ps = ps[to_canonical]
+        self.nodes.add(s, ps, valids[to_canonical])
+        if self.evalCache is not None:
+            self.evalCache.put(s, ps, v)
+        return v
+
+    def expandBatch(self, pending):
+        """Evaluates the pending leaves (s -> (board, sym)) in one forward pass and returns s -> value"""
+        result = {}
+        if self.evalCache is not None:
+            # leaves evaluated before by any search sharing the cache skip the network
+            for s in list(pending):
+                cached = self.evalCache.get(s)
+                if cached is not None:
+                    board, sym = pending.pop(s)
+                    valid = GameRepresentationFunctional.getValidMask(*board)
+                    self.nodes.add(s, cached[0], valid[GameRepresentationFunctional.SYMMETRY_GATHER[sym]])
+                    result[s] = cached[1]
+            if not pending:
+                return result
+
+        boards = [board for board, _ in pending.values()]
+        valids = [GameRepresentationFunctional.getValidMask(*board) for board in boards]
+        policies, values = self.nnet.predict_batch(boards, valids)
 
-        self.Ns[s] += 1
-        return -v
\ No newline at end of file
+        for (s, (board, sym)), ps, valid, v in zip(pending.items(), policies, valids, values):
+            ps = ps / np.sum(ps)  # renormalize
+            to_canonical = GameRepresentationFunctional.SYMMETRY_GATHER[sym]
+            ps = ps[to_canonical]
+            self.nodes.add(s, ps, valid[to_canonical])
+            result[s] = float(v)
+            if self.evalCache is not None:
+                self.evalCache.put(s, ps, float(v))
+        return result
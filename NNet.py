@@ -1,8 +1,12 @@
 import os
+
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+import GameRepresentationFunctional
+
 class UltimateTTTNet(nn.Module):
     def __init__(self, device=None):
         super(UltimateTTTNet, self).__init__()
@@ -67,25 +71,43 @@ class UltimateTTTNet(nn.Module):
         
         return policy, value
 
-    def predict(self, state, valid_moves):
-        """Convert game state to network input and get prediction"""
+    def predict(self, state, valid_mask=None):
+        """Convert game state to network input and get prediction
+
+        valid_mask is the 81-long bool array of legal actions (GameRepresentationFunctional.getValidMask),
+        derived from the state if not given
+        """
+        policy, value = self.predict_batch([state], None if valid_mask is None else [valid_mask])
+        return policy[0], value[0].item()
+
+    def predict_batch(self, states=None, valid_masks=None, planes=None):
+        """Evaluate a batch of positions in one forward pass
+
+        The positions are either a list of states or already encoded input planes of
+        shape (B, 6, 9, 9) (numpy array or tensor, see encode_states).
+        valid_masks holds one 81-long bool array of legal actions per position. If it
+        is not given the masks are derived from the planes for the whole batch at once.
+        Returns the (B, 81) policies and (B,) values as numpy arrays.
+        """
         with torch.no_grad():
-            # Convert state to tensor and move to device
-            x = state_to_tensor(state).to(self.device)
-            
-            # Create valid moves mask
-            mask = torch.zeros(81, dtype=torch.bool, device=self.device)
-            for move in valid_moves:
-                x_pos, y_pos = move
-                mask[y_pos*9 + x_pos] = True
-            
-            # Add batch dimension
-            mask = mask.unsqueeze(0)
-            
-            policy, value = self.forward(x, mask)
-            
+            if planes is None:
+                planes = encode_states(states)
+            x = torch.as_tensor(planes).to(self.device, non_blocking=True)
+            if valid_masks is None:
+                mask = planes_to_valid_masks(x)
+            else:
+                mask = torch.from_numpy(np.asarray(valid_masks, dtype=bool)).to(self.device, non_blocking=True)
+
+            # batch norm has to use its running statistics, otherwise the states of a batch influence each other
+            was_training = self.training
+            self.eval()
+            try:
+                policy, value = self.forward(x, mask)
+            finally:
+                self.train(was_training)
+
             # Move outputs to CPU for numpy conversion
-            return torch.exp(policy).cpu().numpy()[0], value.cpu().item()
+            return torch.exp(policy).cpu().numpy(), value.view(-1).cpu().numpy()
         
     def save_checkpoint(self, folder='checkpoint', filename='checkpoint.pth.tar'):
         filepath = os.path.join(folder, filename)
@@ -114,55 +136,86 @@ class UltimateTTTNet(nn.Module):
         outputs = outputs.to(self.device)
         return torch.sum((targets - outputs.view(-1)) ** 2) / targets.size()[0]
 
-def state_to_tensor(state):
-    """Convert game state to network input tensor"""
-    global_state_x, global_state_o, local_state_x, local_state_o, current_player, current_board, winner = state
-    
-    # Create input planes
-    batch_size = 1
-    planes = torch.zeros((batch_size, 6, 9, 9), dtype=torch.float32)
-    
-    # Plane 0: X positions on all boards
-    for board in range(9):
-        for y in range(3):
-            for x in range(3):
-                if local_state_x[board] & (1 << (y*3 + x)):
-                    planes[0, 0, (board//3)*3 + y, (board%3)*3 + x] = 1
-    
-    # Plane 1: O positions on all boards
-    for board in range(9):
-        for y in range(3):
-            for x in range(3):
-                if local_state_o[board] & (1 << (y*3 + x)):
-                    planes[0, 1, (board//3)*3 + y, (board%3)*3 + x] = 1
-    
+# MASK_PLANES[mask] is the 3x3 plane of a 9-bit local mask
+MASK_PLANES = ((np.arange(512)[:, None] >> np.arange(9)) & 1).astype(np.float32).reshape(512, 3, 3)
+
+# BOARD_PLANES[mask] is the 9x9 plane with the 3x3 block of every local board in the 9-bit mask filled
+BOARD_PLANES = np.kron(MASK_PLANES, np.ones((3, 3), dtype=np.float32))
+
+def _local_planes(local_states):
+    # (B, 9) local masks -> (B, 9, 9) planes, (B, board_y, board_x, y, x) -> (B, board_y, y, board_x, x)
+    planes = MASK_PLANES[local_states]
+    return planes.reshape(-1, 3, 3, 3, 3).transpose(0, 1, 3, 2, 4).reshape(-1, 9, 9)
+
+def encode_batch(global_state_x, global_state_o, local_state_x, local_state_o, current_player, current_board, winner, out=None):
+    """Encode a batch of states given as arrays into one contiguous (B, 6, 9, 9) float32 array
+
+    Takes the batched state of GameRepresentationBatched. out can be a preallocated numpy
+    array or CPU torch tensor (e.g. pinned) of shape (B, 6, 9, 9) to write into.
+    """
+    global_state_x = np.asarray(global_state_x, dtype=np.int64)
+    global_state_o = np.asarray(global_state_o, dtype=np.int64)
+    current_board = np.asarray(current_board, dtype=np.int64)
+    batch_size = len(global_state_x)
+    if out is None:
+        out = np.empty((batch_size, 6, 9, 9), dtype=np.float32)
+    planes = out.numpy() if isinstance(out, torch.Tensor) else out
+
+    # Plane 0/1: X and O positions on all boards
+    planes[:, 0] = _local_planes(np.asarray(local_state_x, dtype=np.int64))
+    planes[:, 1] = _local_planes(np.asarray(local_state_o, dtype=np.int64))
+
     # Plane 2: Current active boards
-    if current_board == 9:  # Free choice
-        for board in range(9):
-            if not (global_state_x & (1 << board)) and not (global_state_o & (1 << board)):
-                y_start = (board // 3) * 3
-                x_start = (board % 3) * 3
-                planes[0, 2, y_start:y_start+3, x_start:x_start+3] = 1
-    else:
-        y_start = (current_board // 3) * 3
-        x_start = (current_board % 3) * 3
-        planes[0, 2, y_start:y_start+3, x_start:x_start+3] = 1
-    
-    # Plane 3: Global X positions
-    for board in range(9):
-        if global_state_x & (1 << board):
-            y_start = (board // 3) * 3
-            x_start = (board % 3) * 3
-            planes[0, 3, y_start:y_start+3, x_start:x_start+3] = 1
-    
-    # Plane 4: Global O positions
-    for board in range(9):
-        if global_state_o & (1 << board):
-            y_start = (board // 3) * 3
-            x_start = (board % 3) * 3
-            planes[0, 4, y_start:y_start+3, x_start:x_start+3] = 1
-    
+    free_boards = ~(global_state_x | global_state_o) & 0b111111111
+    active_boards = np.where(current_board == 9, free_boards, 1 << np.minimum(current_board, 8))
+    planes[:, 2] = BOARD_PLANES[active_boards]
+
+    # Plane 3/4: Global X and O positions
+    planes[:, 3] = BOARD_PLANES[global_state_x]
+    planes[:, 4] = BOARD_PLANES[global_state_o]
+
     # Plane 5: Current player (1 for X, 0 for O)
-    planes[0, 5, :, :] = 1 if current_player else 0
-    
-    return planes
\ No newline at end of file
+    planes[:, 5] = np.asarray(current_player, dtype=np.float32)[:, None, None]
+    return out
+
+def encode_states(states, out=None):
+    """Encode a list of states into one contiguous (B, 6, 9, 9) float32 array"""
+    fields = list(zip(*states))
+    return encode_batch(
+        np.fromiter(fields[0], dtype=np.int64, count=len(states)),
+        np.fromiter(fields[1], dtype=np.int64, count=len(states)),
+        np.array(fields[2], dtype=np.int64).reshape(-1, 9),
+        np.array(fields[3], dtype=np.int64).reshape(-1, 9),
+        np.array([bool(player) for player in fields[4]]),
+        np.fromiter(fields[5], dtype=np.int64, count=len(states)),
+        fields[6],
+        out,
+    )
+
+def planes_to_valid_masks(planes):
+    """Legal actions of encoded planes (B, 6, 9, 9): the empty squares of the active boards, shape (B, 81)
+
+    Works on torch tensors and numpy arrays. Only meaningful for games that are not over.
+    """
+    legal = (planes[:, 2] > 0) & (planes[:, 0] == 0) & (planes[:, 1] == 0)
+    return legal.reshape(-1, 81)
+
+def state_to_tensor(state):
+    """Convert game state to network input tensor of shape (1, 6, 9, 9)"""
+    return torch.from_numpy(encode_states([state]))
+
+# (8, 81) gather indices of the board symmetries, in GameRepresentationFunctional.get_symmetries order
+SYMMETRY_GATHER = torch.as_tensor(GameRepresentationFunctional.SYMMETRY_GATHER)
+
+def symmetric_planes(planes):
+    """Apply the 8 symmetries to already encoded planes of shape (..., 6, 9, 9) with one gather
+
+    Returns shape (8, ..., 6, 9, 9). The i-th entry equals state_to_tensor of the i-th state
+    of get_symmetries. Works on torch tensors and numpy arrays.
+    """
+    flat = planes.reshape(*planes.shape[:-2], 81)
+    if isinstance(planes, torch.Tensor):
+        gathered = torch.movedim(flat[..., SYMMETRY_GATHER], -2, 0)
+    else:
+        gathered = np.moveaxis(flat[..., GameRepresentationFunctional.SYMMETRY_GATHER], -2, 0)
+    return gathered.reshape(8, *planes.shape)
@@ -0,0 +1,173 @@
+import numpy as np
+
+import GameRepresentationFunctional
+
+EPS = 1e-8
+
+# rough per node cost of the hash -> node id dict entry, on top of the pool rows
+INDEX_BYTES_PER_NODE = 100
+
+
+class NodeTable():
+    """
+    Preallocated node pool for MCTSNodeLess.
+
+    Every expanded state, keyed by its zobrist hash, gets an integer node id that
+    addresses one row of contiguous 81-long arrays (one entry per action):
+        N:     #times edge s,a was visited
+        W:     summed values of edge s,a
+        Q:     W / N for legal actions, -inf for illegal ones so selection needs no mask
+        P:     initial policy (returned by neural net)
+        legal: legal actions of s
+    and one entry of Ns (#times s was visited) and gen (generation of the last
+    visit). The pools grow by doubling when full.
+
+    With maxNodes (or maxBytes) the table is bounded: reserve() evicts the nodes
+    of the oldest generations, and within a generation the least visited ones,
+    down to three quarters of the cap.
+    """
+
+    def __init__(self, capacity=1024, maxNodes=None, maxBytes=None):
+        if maxBytes is not None:
+            maxNodes = max(1, maxBytes // self.bytes_per_node())
+        self.maxNodes = maxNodes
+        self.index = {}  # zobrist hash -> node id
+        self.size = 0
+        self.capacity = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.N = np.zeros((0, GameRepresentationFunctional.NUM_ACTIONS), dtype=np.float32)
+        self.W = np.zeros((0, GameRepresentationFunctional.NUM_ACTIONS), dtype=np.float32)
+        self.Q = np.zeros((0, GameRepresentationFunctional.NUM_ACTIONS), dtype=np.float32)
+        self.P = np.zeros((0, GameRepresentationFunctional.NUM_ACTIONS), dtype=np.float32)
+        self.legal = np.zeros((0, GameRepresentationFunctional.NUM_ACTIONS), dtype=bool)
+        self.Ns = np.zeros(0, dtype=np.float32)
+        self.gen = np.zeros(0, dtype=np.int64)
+        self._resize(capacity if maxNodes is None else min(capacity, maxNodes))
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, h):
+        return h in self.index
+
+    @staticmethod
+    def bytes_per_node():
+        # N, W, Q, P (float32) + legal (bool) rows, Ns and gen
+        return GameRepresentationFunctional.NUM_ACTIONS * (4 * 4 + 1) + 4 + 8 + INDEX_BYTES_PER_NODE
+
+    def _arrays(self):
+        return (self.N, self.W, self.Q, self.P, self.legal, self.Ns, self.gen)
+
+    def _resize(self, capacity):
+        def grow(arr):
+            new = np.zeros((capacity,) + arr.shape[1:], dtype=arr.dtype)
+            new[:self.size] = arr[:self.size]
+            return new
+
+        self.N, self.W, self.Q, self.P, self.legal, self.Ns, self.gen = (grow(arr) for arr in self._arrays())
+        self.capacity = capacity
+
+    def get(self, h):
+        """Returns the node id of hash h or -1"""
+        node = self.index.get(h, -1)
+        if node < 0:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return node
+
+    def add(self, h, priors, legal):
+        """Stores a new node with its priors and legal mask and returns its id"""
+        if self.size == self.capacity:
+            capacity = max(1, 2 * self.capacity)
+            if self.maxNodes is not None:
+                # reserve() keeps the size below maxNodes, only callers that skip it grow past the cap
+                capacity = max(min(capacity, self.maxNodes), self.size + 1)
+            self._resize(capacity)
+        node = self.size
+        self.size += 1
+        self.index[h] = node
+        self.N[node] = 0
+        self.W[node] = 0
+        self.Q[node] = np.where(legal, 0, -np.inf)
+        self.P[node] = priors
+        self.legal[node] = legal
+        self.Ns[node] = 0
+        self.gen[node] = self.generation
+        return node
+
+    def select(self, node, cpuct=1):
+        """Returns the legal action with the highest upper confidence bound"""
+        u = self.P[node] / (self.N[node] + 1)
+        u *= cpuct * np.sqrt(self.Ns[node] + EPS)
+        u += self.Q[node]
+        return int(u.argmax())
+
+    def update(self, node, action, v):
+        n = self.N[node, action] + 1
+        w = self.W[node, action] + v
+        self.N[node, action] = n
+        self.W[node, action] = w
+        self.Q[node, action] = w / n
+        self.Ns[node] += 1
+        self.gen[node] = self.generation
+
+    def add_virtual_loss(self, node, action, loss=1):
+        """Counts a pending visit of edge s,a as a loss so parallel descents spread out"""
+        self.update(node, action, -loss)
+
+    def revert_virtual_loss(self, node, action, v, loss=1):
+        """Replaces the virtual loss of edge s,a with the real value v"""
+        w = self.W[node, action] + loss + v
+        self.W[node, action] = w
+        self.Q[node, action] = w / self.N[node, action]
+
+    def retain(self, nodes):
+        """Keeps only the given node ids, compacting them to the front of the pools"""
+        keep = np.array(sorted(nodes), dtype=np.int64)
+        for arr in self._arrays():
+            arr[:len(keep)] = arr[keep]
+        new_ids = {old: new for new, old in enumerate(keep.tolist())}
+        self.index = {h: new_ids[node] for h, node in self.index.items() if node in new_ids}
+        self.size = len(keep)
+
+    def new_generation(self):
+        """Starts a new generation, called when the root moves on"""
+        self.generation += 1
+
+    def reserve(self, count, protect=()):
+        """
+        Makes room for count new nodes under maxNodes, never evicting the nodes
+        of the hashes in protect. Must only be called while no search path holds
+        node ids, eviction renumbers the nodes.
+        """
+        if self.maxNodes is None or self.size + count <= self.maxNodes:
+            return 0
+        target = max(0, min(self.maxNodes * 3 // 4, self.maxNodes - count) - len(protect))
+        # newest generation first, most visited first within a generation
+        order = np.lexsort((-self.Ns[:self.size], -self.gen[:self.size]))
+        keep = set(order[:target].tolist())
+        keep.update(self.index[h] for h in protect if h in self.index)
+        evicted = self.size - len(keep)
+        self.retain(keep)
+        self.evictions += evicted
+        return evicted
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": self.size,
+            "maxNodes": self.maxNodes,
+            "bytes": self.capacity * self.bytes_per_node(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+    def clear(self):
+        self.index.clear()
+        self.size = 0
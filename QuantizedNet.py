@@ -0,0 +1,226 @@
+import copy
+import os
+import random
+from pickle import Unpickler
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.ao.quantization as quantization
+
+import GameRepresentationFunctional
+from Arena import Arena
+from InferenceNet import ScriptedNet, for_inference, sample_planes
+from MCTS_NEW import MCTSNodeLess
+from NNet import UltimateTTTNet, planes_to_valid_masks
+
+# Static int8 quantization for CPU self-play: weights and activations of all convolutions
+# and linear layers are int8, calibrated on positions from stored training examples. Only
+# the masked softmax and the tanh run in float.
+
+# (conv, bn, relu) and (linear, relu) groups folded into one quantized module
+FUSED_MODULES = [
+    ["conv1", "bn1", "relu1"],
+    ["conv2", "bn2", "relu2"],
+    ["conv3", "bn3", "relu3"],
+    ["policy_conv", "policy_bn", "policy_relu"],
+    ["value_conv", "value_bn", "value_relu"],
+    ["value_fc1", "value_fc1_relu"],
+]
+
+
+def default_engine():
+    """Quantized backend of this CPU: x86 (fbgemm + onednn) where available, qnnpack on ARM"""
+    engines = torch.backends.quantized.supported_engines
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in engines:
+            return engine
+    raise RuntimeError(f"no quantized backend available, supported engines: {engines}")
+
+
+class QuantizableUltimateTTTNet(nn.Module):
+    """UltimateTTTNet with quant / dequant stubs and ReLU modules, so eager mode quantization can fuse and convert it"""
+
+    def __init__(self, nnet):
+        super(QuantizableUltimateTTTNet, self).__init__()
+        nnet = copy.deepcopy(nnet).cpu().eval()
+        self.quant = quantization.QuantStub()
+        self.conv1, self.bn1, self.relu1 = nnet.conv1, nnet.bn1, nn.ReLU()
+        self.conv2, self.bn2, self.relu2 = nnet.conv2, nnet.bn2, nn.ReLU()
+        self.conv3, self.bn3, self.relu3 = nnet.conv3, nnet.bn3, nn.ReLU()
+
+        self.policy_conv, self.policy_bn, self.policy_relu = nnet.policy_conv, nnet.policy_bn, nn.ReLU()
+        self.policy_fc = nnet.policy_fc
+        self.policy_dequant = quantization.DeQuantStub()
+
+        self.value_conv, self.value_bn, self.value_relu = nnet.value_conv, nnet.value_bn, nn.ReLU()
+        self.value_fc1, self.value_fc1_relu = nnet.value_fc1, nn.ReLU()
+        self.value_fc2 = nnet.value_fc2
+        self.value_dequant = quantization.DeQuantStub()
+
+    def forward(self, x, valid_moves_mask):
+        # same outputs as UltimateTTTNet.forward in eval mode: (B, 81) log policy and (B, 1) value
+        x = self.quant(x)
+        x = self.relu1(self.bn1(self.conv1(x)))
+        x = self.relu2(self.bn2(self.conv2(x)))
+        x = self.relu3(self.bn3(self.conv3(x)))
+
+        p = self.policy_relu(self.policy_bn(self.policy_conv(x))).reshape(-1, 2*9*9)
+        p = self.policy_dequant(self.policy_fc(p)).masked_fill(~valid_moves_mask, float('-inf'))
+        policy = F.log_softmax(p, dim=1)
+
+        v = self.value_relu(self.value_bn(self.value_conv(x))).reshape(-1, 9*9)
+        v = self.value_fc2(self.value_fc1_relu(self.value_fc1(v)))
+        value = torch.tanh(self.value_dequant(v))
+        return policy, value
+
+
+def load_examples(path):
+    """Training examples of a .examples file written by Coach.saveTrainExamples, as one flat list"""
+    with open(path, "rb") as f:
+        history = Unpickler(f).load()
+    return [example for iteration in history for example in iteration]
+
+def calibration_planes(examples, count=1024, seed=0):
+    """
+    Encoded planes and legal masks of up to count positions drawn from training
+    examples (planes, pi, v). examples may also be Coach.trainExamplesHistory.
+    """
+    examples = list(examples)
+    if examples and not isinstance(examples[0][0], (torch.Tensor, np.ndarray)):
+        # a history: one list of examples per iteration
+        examples = [example for iteration in examples for example in iteration]
+    if len(examples) > count:
+        examples = random.Random(seed).sample(examples, count)
+    planes = torch.stack([torch.as_tensor(example[0]).reshape(6, 9, 9) for example in examples]).float()
+    return planes, planes_to_valid_masks(planes)
+
+
+def quantize(nnet, examples=None, count=1024, engine=None, batchSize=256):
+    """
+    Static int8 copy of nnet for the CPU, calibrated on count positions of the
+    training examples (positions of random games if there are none). Returns a
+    scripted net with the predict / predict_batch interface of UltimateTTTNet.
+    Sets the quantized backend of this process to engine.
+    """
+    engine = engine or default_engine()
+    torch.backends.quantized.engine = engine
+    if examples:
+        planes, masks = calibration_planes(examples, count)
+    else:
+        planes, masks = sample_planes(count)
+
+    model = QuantizableUltimateTTTNet(nnet).eval()
+    quantization.fuse_modules(model, FUSED_MODULES, inplace=True)
+    model.qconfig = quantization.get_default_qconfig(engine)
+    quantization.prepare(model, inplace=True)
+    with torch.no_grad():
+        for start in range(0, len(planes), batchSize):
+            model(planes[start:start + batchSize], masks[start:start + batchSize])
+    quantization.convert(model, inplace=True)
+    return ScriptedNet(torch.jit.freeze(torch.jit.script(model)))
+
+def load_quantized(path, engine=None):
+    """Loads a quantized net saved with ScriptedNet.save, the backend has to match the one it was quantized with"""
+    torch.backends.quantized.engine = engine or default_engine()
+    return ScriptedNet.load(path)
+
+
+def agreement(nnet, quantized, planes=None, masks=None):
+    """Top-1 policy agreement and the largest / mean differences of the policies and values on the given positions"""
+    if planes is None:
+        planes, masks = sample_planes()
+    was_training = nnet.training
+    nnet.eval()
+    try:
+        with torch.no_grad():
+            policy, value = nnet(planes.to(nnet.device), masks.to(nnet.device))
+    finally:
+        nnet.train(was_training)
+    policy, value = torch.exp(policy).cpu(), value.cpu()
+    quantized_policy, quantized_value = quantized.forward(planes, masks)
+    quantized_policy = torch.exp(quantized_policy)
+    policy_diff = (policy - quantized_policy).abs()
+    value_diff = (value - quantized_value).abs()
+    return {
+        "top1": (policy.argmax(1) == quantized_policy.argmax(1)).float().mean().item(),
+        "policyMaxDiff": policy_diff.max().item(),
+        "policyMeanDiff": policy_diff.sum(1).mean().item() / 2,  # total variation distance
+        "valueMaxDiff": value_diff.max().item(),
+        "valueMeanDiff": value_diff.mean().item(),
+    }
+
+def mcts_player(nnet, numMCTSSims, parallelLeaves=8, openingMoves=4):
+    # Arena player: samples from the visit counts for the first openingMoves moves so the games differ, then plays the best move
+    mcts = MCTSNodeLess(nnet, numMCTSSims, parallelLeaves=parallelLeaves, maxNodes=50000)
+
+    def play(state):
+        if GameRepresentationFunctional.stonesPlaced(*state) < openingMoves:
+            pi = mcts.getActionProb(state, temp=1)
+            return int(np.random.choice(len(pi), p=pi))
+        return int(np.argmax(mcts.getActionProb(state, temp=0)))
+    return play
+
+def compare_strength(nnet, quantized, games=40, numMCTSSims=50, parallelLeaves=8, tolerance=0.1):
+    """
+    Plays games Arena games of the quantized net against the float net (optimized
+    through InferenceNet), both searching with MCTSNodeLess. The quantized net
+    passes if its score (wins + draws / 2 per game) is at least 0.5 - tolerance.
+    With few games the score is noisy, tolerance should cover about two standard
+    errors (0.5 / sqrt(games) per standard error).
+    """
+    arena = Arena(mcts_player(quantized, numMCTSSims, parallelLeaves),
+                  mcts_player(for_inference(nnet), numMCTSSims, parallelLeaves))
+    quantized_wins, float_wins, draws = arena.playGames(games)
+    played = quantized_wins + float_wins + draws
+    score = (quantized_wins + draws / 2) / played if played else 0.0
+    return {
+        "quantizedWins": quantized_wins,
+        "floatWins": float_wins,
+        "draws": draws,
+        "score": score,
+        "passed": score >= 0.5 - tolerance,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Quantize a checkpoint to int8, compare it with the float net and save it.")
+    parser.add_argument("checkpoint", nargs="?", default=None, help="Checkpoint file, a random net if not given")
+    parser.add_argument("--examples", default=None, help="Training examples for the calibration, <checkpoint>.examples if it exists")
+    parser.add_argument("--calibration", type=int, default=1024, help="Positions used for the calibration")
+    parser.add_argument("--games", type=int, default=40, help="Arena games against the float net, 0 to skip")
+    parser.add_argument("--sims", type=int, default=50, help="MCTS simulations per move in the arena")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Largest allowed score loss against the float net")
+    parser.add_argument("--out", default="temp/best.int8.pt")
+    args = parser.parse_args()
+
+    nnet = UltimateTTTNet(torch.device("cpu"))
+    if args.checkpoint:
+        folder, filename = os.path.split(args.checkpoint)
+        nnet.load_checkpoint(folder or ".", filename)
+        if args.examples is None and os.path.isfile(args.checkpoint + ".examples"):
+            args.examples = args.checkpoint + ".examples"
+    examples = load_examples(args.examples) if args.examples else None
+    print(f"calibrating on {'training examples' if examples else 'random positions'}")
+
+    quantized = quantize(nnet, examples, args.calibration)
+    quantized.save(args.out)
+    quantized = load_quantized(args.out)
+    planes, masks = calibration_planes(examples, 256, seed=1) if examples else sample_planes(256, seed=1)
+    print(f"saved to {args.out}, agreement with the float net: {agreement(nnet, quantized, planes, masks)}")
+
+    optimized = for_inference(nnet, True)
+    for batch in (1, 8, 64):
+        for name, net in (("float", optimized), ("int8", quantized)):
+            start = time.perf_counter()
+            for _ in range(200 // batch + 10):
+                net.predict_batch(planes=planes[:batch], valid_masks=masks[:batch].numpy())
+            elapsed = (time.perf_counter() - start) / (200 // batch + 10)
+            print(f"batch {batch:3d} {name:5s} {elapsed * 1000:.2f} ms")
+
+    if args.games:
+        print(f"arena against the float net: {compare_strength(nnet, quantized, args.games, args.sims, tolerance=args.tolerance)}")
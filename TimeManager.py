@@ -0,0 +1,90 @@
+import math
+import time
+
+
+class TimeManager():
+    """
+    Splits the clock of one game over our moves.
+
+    Every move gets a soft and a hard budget. The search runs till the soft
+    deadline and then continues towards the hard one the more undecided the
+    root still is, i.e. the higher the entropy of its visit counts. A fixed
+    latency margin is kept off the clock for the round trip to the server.
+    """
+
+    def __init__(self, gameTime=60.0, increment=0.0, latencyMargin=0.25, minMovesToGo=8, maxMovesToGo=30,
+                 minTime=0.01, extendFactor=2.0, maxFraction=0.2, entropyThreshold=0.6):
+        self.gameTime = gameTime
+        self.increment = increment
+        self.latencyMargin = latencyMargin  # seconds per move reserved for the network
+        self.minMovesToGo = minMovesToGo
+        self.maxMovesToGo = maxMovesToGo
+        self.minTime = minTime
+        self.extendFactor = extendFactor  # hard budget = extendFactor * soft budget
+        self.maxFraction = maxFraction  # never spend more than this fraction of the clock on one move
+        self.entropyThreshold = entropyThreshold  # normalized entropy of the root visits above which the search is extended
+        self.new_game()
+
+    def new_game(self, timeLeft=None):
+        self.timeLeft = self.gameTime if timeLeft is None else timeLeft
+        self.moveStart = None
+
+    def moves_to_go(self, state):
+        """Estimates how many moves we still have to make in this game"""
+        global_x, global_o, local_x, local_o = state[:4]
+        decided = global_x | global_o
+        empty = sum(9 - bin(local_x[b] | local_o[b]).count("1") for b in range(9) if not decided >> b & 1)
+        # most games end long before the board is full, about a quarter of the empty squares are ours
+        return min(self.maxMovesToGo, max(self.minMovesToGo, empty // 4))
+
+    def budget(self, state, timeLeft=None):
+        """Returns the (soft, hard) thinking time in seconds for a move in state"""
+        if timeLeft is None:
+            timeLeft = self.timeLeft
+        usable = max(0.0, timeLeft - self.latencyMargin)
+        soft = usable / self.moves_to_go(state) + self.increment
+        hard = min(usable * self.maxFraction, soft * self.extendFactor)
+        soft = min(soft, hard)
+        return max(self.minTime, soft), max(self.minTime, hard)
+
+    def start_move(self):
+        """Starts our clock, call it as soon as the opponent's move arrived"""
+        self.moveStart = time.monotonic()
+
+    def deadlines(self, state, timeLeft=None):
+        """Returns the soft and hard budget as time.monotonic() deadlines"""
+        if self.moveStart is None:
+            self.start_move()
+        soft, hard = self.budget(state, timeLeft)
+        return self.moveStart + soft, self.moveStart + hard
+
+    def end_move(self):
+        """Stops our clock after the move was sent and returns the time it took"""
+        if self.moveStart is None:
+            return 0.0
+        elapsed = time.monotonic() - self.moveStart
+        self.timeLeft = max(0.0, self.timeLeft - elapsed) + self.increment
+        self.moveStart = None
+        return elapsed
+
+    def extended_deadline(self, soft, hard, counts):
+        """
+        Returns the deadline to search on to after the soft deadline passed.
+        It moves from soft to hard as the normalized entropy of the root visit
+        counts goes from entropyThreshold to 1.
+        """
+        entropy = normalized_entropy(counts)
+        if entropy <= self.entropyThreshold:
+            return soft
+        return soft + (hard - soft) * (entropy - self.entropyThreshold) / (1 - self.entropyThreshold)
+
+
+def normalized_entropy(counts):
+    """Entropy of the visit distribution divided by its maximum, 0 for a single candidate"""
+    counts = [c for c in counts if c > 0]
+    total = sum(counts)
+    if len(counts) < 2 or total <= 0:
+        return 0.0
+    entropy = -sum(c / total * math.log(c / total) for c in counts)
+    return entropy / math.log(len(counts))
+
@@ -0,0 +1,151 @@
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import GameRepresentationFunctional
+import websocketClient
+from BatchingEvaluator import BatchingEvaluator
+from EvaluationCache import EvaluationCache
+from MCTS_NEW import MCTSNodeLess
+from TimeManager import TimeManager
+
+
+class NetEngine:
+    """Plays one game with MCTSNodeLess, keeping its tree between moves. Same interface as selfPlayEngine.Engine,
+    nnet may be a BatchingEvaluator shared with other games."""
+
+    def __init__(self, nnet, numMCTSSims=800, parallelLeaves=8, timeManager=None, maxNodes=None, ponderLimit=None, evalCache=None):
+        self.mcts = MCTSNodeLess(nnet, numMCTSSims, parallelLeaves=parallelLeaves, maxNodes=maxNodes, evalCache=evalCache)
+        self.numMCTSSims = numMCTSSims
+        self.timeManager = timeManager
+        self.ponderLimit = numMCTSSims if ponderLimit is None else ponderLimit
+        self.state = None  # state after our last move
+
+    def best_move(self, state, timeLeft=None, stop=None):
+        """Searches state and returns our move (x, y). Returns None if stop was set while searching."""
+        moves = GameRepresentationFunctional.getPossibleMoves(*state)
+        if len(moves) == 1:
+            # forced move, answer instantly
+            best_move = moves[0]
+        else:
+            hs = GameRepresentationFunctional.symmetric_zobrists(*state, table=self.mcts.zobristTable)
+            self.mcts.update_root(state, hs)
+            if self.timeManager is None:
+                self.mcts.searchUntil(state, hs=hs, stop=stop)
+            else:
+                soft, hard = self.timeManager.deadlines(state, timeLeft)
+                sims = self.mcts.searchUntil(state, soft, hs=hs, stop=stop)
+                # undecided root, keep searching towards the hard deadline
+                deadline = self.timeManager.extended_deadline(soft, hard, self.mcts.getRootCounts(hs))
+                if sims < self.numMCTSSims and time.monotonic() < deadline:
+                    self.mcts.searchUntil(state, deadline, self.numMCTSSims - sims, hs, stop)
+            if stop is not None and stop.is_set():
+                return None
+
+            counts = self.mcts.getRootCounts(hs)
+            if counts.sum() > 0:
+                counts[~GameRepresentationFunctional.getValidMask(*state)] = -1
+                best_move = GameRepresentationFunctional.action_to_move(int(counts.argmax()))
+            else:
+                # no simulation finished in time
+                best_move = moves[np.random.randint(len(moves))]
+
+        self.state = GameRepresentationFunctional.move(*state, *best_move)
+        return best_move
+
+    def ponder(self, stop):
+        """Searches the position after our last move till stop is set or ponderLimit simulations are done"""
+        if self.state is None or self.state[-1] is not None:
+            return 0
+        self.mcts.update_root(self.state)
+        return self.mcts.searchUntil(self.state, numMCTSSims=self.ponderLimit, stop=stop)
+
+
+class EngineService:
+    """
+    Long-lived engine that plays many websocket games at once.
+
+    Every connection plays one game with its own NetEngine (warm tree) and
+    clock. When a game ends the connection is reopened for the next one. The
+    searches of all games run in one thread pool and send their leaves to one
+    BatchingEvaluator, so the network is loaded once and evaluates the leaves
+    of all games together. Positions one game evaluated (openings above all)
+    are taken from an evaluation cache shared by all games.
+    """
+
+    def __init__(self, nnet, numMCTSSims=800, parallelLeaves=8, gameTime=60.0, latency=0.25, maxNodes=200000,
+                 maxBatch=256, maxWait=0.002, ponder=True, evalCacheSize=200000):
+        self.evaluator = BatchingEvaluator(nnet, maxBatch, maxWait)
+        self.evalCache = EvaluationCache(evalCacheSize) if evalCacheSize else None
+        self.numMCTSSims = numMCTSSims
+        self.parallelLeaves = parallelLeaves
+        self.gameTime = gameTime
+        self.latency = latency
+        self.maxNodes = maxNodes
+        self.ponder = ponder
+        self.gamesPlayed = 0
+
+    def new_engine(self):
+        time_manager = TimeManager(gameTime=self.gameTime, latencyMargin=self.latency)
+        engine = NetEngine(self.evaluator, self.numMCTSSims, self.parallelLeaves, time_manager, self.maxNodes, evalCache=self.evalCache)
+        return engine, time_manager
+
+    async def run_connection(self, uri, executor, games=None):
+        # plays games on one connection slot, reconnecting after every game
+        played = 0
+        while games is None or played < games:
+            client = websocketClient.TicTacToeClient(uri)
+            try:
+                await client.connect()
+            except OSError as e:
+                print(f"Could not connect to {uri}: {e}")
+                await asyncio.sleep(1)
+                continue
+            engine, time_manager = self.new_engine()
+            await websocketClient.play(client, engine, time_manager, executor, self.ponder)
+            await client.disconnect()
+            played += 1
+            self.gamesPlayed += 1
+
+    async def serve(self, uri, connections=32, games=None):
+        """Plays on connections concurrent connections, games games each (None: forever)"""
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            await asyncio.gather(*(self.run_connection(uri, executor, games) for _ in range(connections)))
+
+    def stats(self):
+        stats = dict(self.evaluator.stats(), gamesPlayed=self.gamesPlayed)
+        if self.evalCache is not None:
+            stats["evalCache"] = self.evalCache.stats()
+        return stats
+
+    def close(self):
+        self.evaluator.close()
+
+
+if __name__ == "__main__":
+    from InferenceNet import for_inference, load_network
+    from NNet import UltimateTTTNet
+
+    parser = argparse.ArgumentParser(description="Play many concurrent games on the Tic-Tac-Toe WebSocket server.")
+    parser.add_argument("uri", help="WebSocket server URI (e.g., ws://localhost:PORT)")
+    parser.add_argument("--connections", type=int, default=32, help="Number of concurrent games")
+    parser.add_argument("--games", type=int, default=None, help="Games per connection, forever if not given")
+    parser.add_argument("--sims", type=int, default=800, help="Maximum MCTS simulations per move")
+    parser.add_argument("--game-time", type=float, default=60.0, help="Thinking time for the whole game in seconds")
+    parser.add_argument("--latency", type=float, default=0.25, help="Seconds per move kept back for the network")
+    parser.add_argument("--checkpoint", default=None, help="Checkpoint file or exported TorchScript net (.pt) of the network")
+    parser.add_argument("--no-optimize", action="store_true", help="Search with the plain network instead of the optimized one")
+    args = parser.parse_args()
+
+    optimized = False if args.no_optimize else None
+    nnet = load_network(args.checkpoint, optimized) if args.checkpoint else for_inference(UltimateTTTNet(), optimized)
+
+    service = EngineService(nnet, args.sims, gameTime=args.game_time, latency=args.latency)
+    try:
+        asyncio.run(service.serve(args.uri, args.connections, args.games))
+    finally:
+        print(service.stats())
+        service.close()
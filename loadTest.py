@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import random
+import time
+
+import numpy as np
+import websockets
+
+import GameRepresentationFunctional as GRF
+
+# local stand-in for the game server, speaks the protocol of websocketClient:
+#   server -> bot: {"last_move": [x, y] or None, "player": 1 (x) or 2 (o), "game_state": 9 local boards of 9 cells}
+#   bot -> server: {"move": [x, y]}
+# a finished game is announced with a non-JSON text message ("Winner X", "Winner O" or "Draw")
+
+
+def state_to_board(state):
+    # the game_state field: game_state[board][cell] is 0 (empty), 1 (x) or 2 (o)
+    return [[1 if state[2][b] >> c & 1 else 2 if state[3][b] >> c & 1 else 0 for c in range(9)] for b in range(9)]
+
+def result_message(state):
+    return {1: "Winner X", -1: "Winner O"}.get(state[-1], "Draw")
+
+
+class StandInServer:
+    """
+    Plays every connection as one game against the bot with a random or a
+    scripted opponent and records the move latency (message sent to move
+    received) and the errors of the bot.
+
+    script is a list of move lists, game i plays script[i % len(script)] and
+    falls back to random moves once the script is exhausted or illegal.
+    The bot plays x in even and o in odd games.
+    """
+
+    def __init__(self, opponent="random", script=None, opponentDelay=0.0, moveTimeout=30.0, seed=None):
+        self.opponent = opponent
+        self.script = script or []
+        self.opponentDelay = opponentDelay
+        self.moveTimeout = moveTimeout
+        self.rng = random.Random(seed)
+        self.latencies = []
+        self.errors = {"timeout": 0, "illegal": 0, "malformed": 0, "disconnect": 0}
+        self.results = {"Winner X": 0, "Winner O": 0, "Draw": 0}
+        self.games = 0
+        self.start = None
+
+    def opponent_move(self, state, game, ply):
+        moves = GRF.getPossibleMoves(*state)
+        if self.opponent == "script" and self.script:
+            script = self.script[game % len(self.script)]
+            if ply < len(script) and tuple(script[ply]) in moves:
+                return tuple(script[ply])
+        return self.rng.choice(moves)
+
+    async def handler(self, websocket):
+        if self.start is None:
+            self.start = time.monotonic()
+        game = self.games
+        self.games += 1
+        bot_x = game % 2 == 0
+        state = GRF.INITIAL_STATE
+        last_move = None
+        ply = 0
+        try:
+            if not bot_x:
+                last_move = self.opponent_move(state, game, ply)
+                state = GRF.move(*state, *last_move)
+                ply += 1
+            while state[-1] is None:
+                await websocket.send(json.dumps({
+                    "last_move": None if last_move is None else list(last_move),
+                    "player": 1 if bot_x else 2,
+                    "game_state": state_to_board(state),
+                }))
+                sent = time.monotonic()
+                try:
+                    msg = await asyncio.wait_for(websocket.recv(), self.moveTimeout)
+                except asyncio.TimeoutError:
+                    self.errors["timeout"] += 1
+                    return
+                self.latencies.append(time.monotonic() - sent)
+                try:
+                    bot_move = tuple(json.loads(msg)["move"])
+                except (ValueError, KeyError, TypeError):
+                    self.errors["malformed"] += 1
+                    return
+                if bot_move not in GRF.getPossibleMoves(*state):
+                    self.errors["illegal"] += 1
+                    return
+                state = GRF.move(*state, *bot_move)
+                ply += 1
+                if state[-1] is not None:
+                    break
+
+                if self.opponentDelay:
+                    await asyncio.sleep(self.opponentDelay)
+                last_move = self.opponent_move(state, game, ply)
+                state = GRF.move(*state, *last_move)
+                ply += 1
+            self.results[result_message(state)] += 1
+            await websocket.send(result_message(state))
+        except websockets.ConnectionClosed:
+            self.errors["disconnect"] += 1
+
+    def report(self):
+        """Move latency percentiles in ms, throughput and error rate"""
+        elapsed = time.monotonic() - self.start if self.start is not None else 0.0
+        latencies = np.array(self.latencies) * 1000
+        errors = sum(self.errors.values())
+        percentiles = np.percentile(latencies, [50, 95, 99]) if len(latencies) else [float("nan")] * 3
+        return {
+            "games": self.games,
+            "moves": len(latencies),
+            "p50": float(percentiles[0]),
+            "p95": float(percentiles[1]),
+            "p99": float(percentiles[2]),
+            "max": float(latencies.max()) if len(latencies) else float("nan"),
+            "movesPerSecond": len(latencies) / elapsed if elapsed else 0.0,
+            "gamesPerSecond": sum(self.results.values()) / elapsed if elapsed else 0.0,
+            "errors": dict(self.errors),
+            "errorRate": errors / self.games if self.games else 0.0,
+            "results": dict(self.results),
+        }
+
+
+def print_report(report):
+    print(f"games {report['games']}, moves {report['moves']}, results {report['results']}")
+    print(f"latency ms  p50 {report['p50']:.1f}  p95 {report['p95']:.1f}  p99 {report['p99']:.1f}  max {report['max']:.1f}")
+    print(f"throughput  {report['movesPerSecond']:.1f} moves/s  {report['gamesPerSecond']:.2f} games/s")
+    print(f"errors      {report['errors']}  rate {report['errorRate']:.3f} per game")
+
+
+async def run_client(kind, uri, connections, games, args):
+    # drives connections simultaneous games, games per connection, with the bot running in this process
+    if kind == "client":
+        import websocketClient
+        for _ in range(games):
+            await websocketClient.main(uri, args.game_time, args.latency, args.iterations, not args.no_ponder, connections)
+    elif kind == "service":
+        from engineService import EngineService
+        from InferenceNet import for_inference
+        from NNet import UltimateTTTNet
+        service = EngineService(for_inference(UltimateTTTNet()), args.sims, gameTime=args.game_time, latency=args.latency, ponder=not args.no_ponder)
+        try:
+            await service.serve(uri, connections, games)
+        finally:
+            print(service.stats())
+            service.close()
+
+
+async def load_test(args):
+    script = None
+    if args.script:
+        with open(args.script) as f:
+            script = json.load(f)
+    server = StandInServer(args.opponent, script, args.opponent_delay, args.move_timeout, args.seed)
+    async with websockets.serve(server.handler, args.host, args.port):
+        uri = f"ws://{args.host}:{args.port}"
+        if args.bot == "none":
+            print(f"Serving on {uri}, stop with Ctrl+C")
+            try:
+                await asyncio.Future()
+            finally:
+                print_report(server.report())
+        # the bot prints every message, keep the report readable
+        output = io.StringIO() if args.quiet else None
+        with contextlib.redirect_stdout(output) if output else contextlib.nullcontext():
+            await run_client(args.bot, uri, args.connections, args.games, args)
+    report = server.report()
+    print_report(report)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in game server and latency load test for the websocket bot.")
+    parser.add_argument("--bot", choices=["client", "service", "none"], default="client",
+                        help="Bot to run in this process (websocketClient, engineService) or none to only serve")
+    parser.add_argument("--connections", type=int, default=8, help="Simultaneous games")
+    parser.add_argument("--games", type=int, default=1, help="Games per connection")
+    parser.add_argument("--opponent", choices=["random", "script"], default="random")
+    parser.add_argument("--script", default=None, help="JSON file with a list of move lists for the scripted opponent")
+    parser.add_argument("--opponent-delay", type=float, default=0.0, help="Seconds the opponent thinks per move")
+    parser.add_argument("--move-timeout", type=float, default=30.0, help="Seconds the bot gets per move before it counts as an error")
+    parser.add_argument("--game-time", type=float, default=60.0, help="Thinking time of the bot per game in seconds")
+    parser.add_argument("--latency", type=float, default=0.25, help="Seconds per move the bot keeps back for the network")
+    parser.add_argument("--iterations", type=int, default=10000, help="Maximum MCTS iterations per move (client)")
+    parser.add_argument("--sims", type=int, default=200, help="Maximum MCTS simulations per move (service)")
+    parser.add_argument("--no-ponder", action="store_true", help="Do not search on the opponent's time")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--quiet", action="store_true", help="Hide the output of the bot")
+    args = parser.parse_args()
+
+    asyncio.run(load_test(args))
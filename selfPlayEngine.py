@@ -1,22 +1,93 @@
+import random
+import time
+
 import GameRepresentationFunctional 
-from MCTS import MCTS
+from MCTS import MCTS, RootParallelMCTS
 from NNet import UltimateTTTNet
+from InferenceNet import for_inference
 
-def best_move(state):
-    mcts = MCTS(state, 10000)
-    mcts.search()
-    best_action = mcts.get_best_action()
-    if best_action:
+class Engine:
+    """Keeps the search tree between moves so the subtree of the position that was reached is reused.
+    With a time manager the search runs against the clock, iteration_limit then only caps the node budget.
+    With workers > 1 the position is searched root-parallel in a process pool, no tree is kept then."""
+
+    def __init__(self, iteration_limit=10000, nnet=None, timeManager=None, ponderLimit=None, workers=1):
+        self.iteration_limit = iteration_limit
+        self.nnet = nnet
+        # rollouts of the single process search use the optimized net, the workers optimize their own copy
+        self.searchNet = for_inference(nnet) if nnet is not None else None
+        self.timeManager = timeManager
+        self.workers = workers
+        # most iterations spent pondering one opponent move, bounds the tree while the opponent thinks
+        self.ponderLimit = iteration_limit if ponderLimit is None else ponderLimit
+        self.mcts = None
+
+    def best_move(self, state, timeLeft=None, stop=None):
+        """Searches state and returns our move. If the threading.Event stop is set while
+        searching, the search is cancelled and None is returned without advancing the tree."""
+        if self.mcts is None:
+            if self.workers > 1:
+                self.mcts = RootParallelMCTS(state, self.iteration_limit, self.nnet, self.workers)
+            else:
+                self.mcts = MCTS(state, self.iteration_limit, self.searchNet)
+        else:
+            # state is usually our last move followed by the opponent's reply
+            self.mcts.update_root_state(state)
+
+        moves = GameRepresentationFunctional.getPossibleMoves(*state)
+        if len(moves) == 1:
+            # forced move, answer instantly
+            best_action = moves[0]
+        elif self.timeManager is None:
+            best_action = self.mcts.search(stop=stop)
+        else:
+            soft, hard = self.timeManager.deadlines(state, timeLeft)
+            best_action = self.mcts.search(deadline=soft, stop=stop)
+            iterations = self.mcts.iterations
+            # undecided root, keep searching towards the hard deadline, the visits add to those of the soft search
+            deadline = self.timeManager.extended_deadline(soft, hard, self.mcts.get_visit_counts())
+            if iterations < self.iteration_limit and time.monotonic() < deadline:
+                best_action = self.mcts.search(deadline=deadline, iteration_limit=self.iteration_limit - iterations, stop=stop)
+                iterations += self.mcts.iterations
+            self.mcts.iterations = iterations
+
+        if stop is not None and stop.is_set():
+            return None
+        if not best_action:
+            # no iteration finished, e.g. every root-parallel worker was past the deadline
+            print("no action found, playing a random move")
+            best_action = random.choice(moves)
+        self.mcts.update_root(best_action)
         return best_action
-    else:
-        print("no action found")
+
+    def ponder(self, stop):
+        """Searches the position after our last move (the opponent to move) till the
+        threading.Event stop is set or ponderLimit iterations are done. The reply of the
+        opponent is then found below the root by the next best_move, so the time spent
+        here is reused. Must not run at the same time as best_move.
+        Returns the number of iterations run."""
+        if self.mcts is None or self.workers > 1 or self.mcts.is_terminal():
+            # the root-parallel search keeps no tree to ponder into
+            return 0
+        self.mcts.search(iteration_limit=self.ponderLimit, stop=stop)
+        return self.mcts.iterations
+
+    def close(self):
+        if isinstance(self.mcts, RootParallelMCTS):
+            self.mcts.close()
+
+_engine = Engine()
+
+def best_move(state):
+    return _engine.best_move(state)
 
 def play_interface():
     state = GameRepresentationFunctional.INITIAL_STATE
+    mcts = MCTS(state, 10000)#, UltimateTTTNet())
     while(1):
-        mcts = MCTS(state, 10000)#, UltimateTTTNet())
         mcts.search()
         best_action = mcts.get_best_action()
+        mcts.update_root(best_action)
         state = GameRepresentationFunctional.move(*state, *best_action)
         print(f"last_move {best_action}")
         print(GameRepresentationFunctional.stringRep(*state))
@@ -29,6 +100,7 @@ def play_interface():
             zahl2 = int(input("Gib die zweite Zahl ein: "))
 
         state = GameRepresentationFunctional.move(*state, zahl1, zahl2)
+        print(f"reused visits {mcts.update_root((zahl1, zahl2))}")
         print(GameRepresentationFunctional.stringRep(*state))
 
 def play_person():
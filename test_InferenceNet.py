@@ -0,0 +1,32 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from InferenceNet import ScriptedNet, for_inference, sample_planes
+from NNet import UltimateTTTNet
+
+
+def random_nnet(seed=0):
+    # batch norms with non-trivial statistics, so folding them into the convolutions is really checked
+    torch.manual_seed(seed)
+    nnet = UltimateTTTNet(torch.device("cpu"))
+    for module in nnet.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2.0)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.5, 0.5)
+    return nnet.eval()
+
+
+def test_for_inference_matches_float_net():
+    nnet = random_nnet()
+    optimized = for_inference(nnet, True)
+    assert isinstance(optimized, ScriptedNet)
+
+    planes, masks = sample_planes(64, seed=1)
+    with torch.no_grad():
+        policy, value = nnet(planes, masks)
+    fused_policy, fused_value = optimized.forward(planes, masks)
+    assert torch.allclose(torch.exp(fused_policy), torch.exp(policy), atol=1e-4)
+    assert torch.allclose(fused_value, value, atol=1e-4)
@@ -0,0 +1,25 @@
+import time
+
+import GameRepresentationFunctional
+from MCTS import RootParallelMCTS
+
+
+def test_root_parallel_phases_add_up():
+    # the soft deadline search and its extension both count for the move that is picked
+    mcts = RootParallelMCTS(GameRepresentationFunctional.INITIAL_STATE, 200, workers=2, seed=0)
+    try:
+        mcts.search(deadline=time.monotonic() + 10, iteration_limit=60)
+        soft = {action: visits for action, (visits, _) in mcts.stats.items()}
+        soft_iterations = mcts.iterations
+        assert sum(soft.values()) == soft_iterations > 0
+
+        best_action = mcts.search(deadline=time.monotonic() + 10, iteration_limit=40)
+        assert sum(mcts.get_visit_counts()) == soft_iterations + mcts.iterations
+        assert all(mcts.stats[action][0] >= visits for action, visits in soft.items())
+        assert best_action == mcts.get_best_action()
+
+        # a new root starts from no statistics
+        mcts.update_root(best_action)
+        assert mcts.get_visit_counts() == []
+    finally:
+        mcts.close()
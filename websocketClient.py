@@ -2,8 +2,11 @@ import asyncio
 import websockets
 import json
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import selfPlayEngine
 import GameRepresentationFunctional as GRF
+from TimeManager import TimeManager
 
 import random
 
@@ -16,7 +19,8 @@ class TicTacToeClient:
 
     # Connect to the server
     async def connect(self):
-        self.websocket = await websockets.connect(self.uri, ping_interval=None, ping_timeout=None)
+        # searches run in an executor, so the event loop is free to answer keepalive pings
+        self.websocket = await websockets.connect(self.uri)
         print(f"Connected to the server at {self.uri}")
 
     # Disconnect from the server
@@ -57,58 +61,148 @@ class TicTacToeClient:
         for i in range(9):
             if GRF.checkWin(local_state_x[i]):
                 global_state_x |= (1 << i)
-            if GRF.checkWin(local_state_o[i]):
+            elif GRF.checkWin(local_state_o[i]):
+                global_state_o |= (1 << i)
+            elif GRF.checkDraw(local_state_x[i], local_state_o[i]):
                 global_state_x |= (1 << i)
+                global_state_o |= (1 << i)
         
-        #setting currentPlayer
-        currentPlayer = "X" if player == 1 else "O"
+        #setting currentPlayer (True is x, like in GameRepresentationFunctional)
+        currentPlayer = player == 1
 
-        #setting currentBoard
-        currentBoard = 9 if last_move == None else last_move[0] % 3 + last_move[1] // 3 * 3
+        #setting currentBoard, the cell of the last move inside its local board
+        currentBoard = 9 if last_move == None else last_move[0] % 3 + last_move[1] % 3 * 3
         if GRF.isNotPlayableBoard(global_state_x, global_state_o, currentBoard):
             currentBoard = 9
 
         # setting winner
         winner = None
-        game_state = (global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner)
+        game_state = GRF.freeze_state(global_state_x, global_state_o, local_state_x, local_state_o, currentPlayer, currentBoard, winner)
         print(game_state)
         return game_state
 
-async def main(uri):
-    client = TicTacToeClient(uri)
-
-    # Connect to the server
-    await client.connect()
-
-    while True:
-        # Get initial last_move or game state
-        server_msg = await client.receive_move_message_or_none()
-        if(server_msg is None):
-            return None  # handle "Winner X" => restart model
-
-        last_move = server_msg.get("last_move", None)
-        state = server_msg.get("game_state", None)
-        player = server_msg.get("player", None)
-
-
-        if(last_move == None or state == None):
-            print("No message from server...")
-
-        print(last_move) #debugging
-        print(state) # debugging
-
-        # state = (global_state x, global state o, local state x, local state o, currentplayer, currentboard, winner)
-        game_state = client.parse_server_msg(last_move,player,state)
-        
-
-        # calc move
-        my_move = selfPlayEngine.best_move(*game_state)  
-
-        # Make a move
-        await client.make_move(my_move)
+def apply_last_move(previous, last_move, game_state):
+    # advances previous (the state after our last move) by the opponent's last_move
+    # and checks it against game_state, the state parsed from the full board
+    # falls back to the full board if the two disagree
+    if previous is None or last_move is None or previous[-1] is not None:
+        return game_state
+    last_move = tuple(last_move)
+    if last_move not in GRF.getPossibleMoves(*previous):
+        print(f"last_move {last_move} is not legal in our state, using the full board")
+        return game_state
+    state = GRF.move(*previous, *last_move)
+    # the server sends no winner, so only the board, player and current board are compared
+    if state[:6] != game_state[:6]:
+        print("state out of sync with the server, using the full board")
+        return game_state
+    return state
+
+async def stop_job(job):
+    # job = (stop event, future of a search running in the executor) or None
+    if job is None:
+        return None
+    stop, future = job
+    stop.set()
+    return await future
+
+def start_job(executor, func, *args):
+    # runs func(*args, stop) in the executor so the event loop keeps serving pings and other connections
+    stop = threading.Event()
+    return stop, asyncio.get_running_loop().run_in_executor(executor, func, *args, stop)
+
+async def play(client, engine, time_manager, executor, ponder=True):
+    # plays on one connection till the server sends a non-JSON message (game over) or closes it
+    # the search runs in the executor while we keep listening, a new message cancels it
+    job = None
+    previous = None  # our state after the last move we sent
+    receive = asyncio.ensure_future(client.receive_move_message_or_none())
+    try:
+        while True:
+            # Get initial last_move or game state
+            server_msg = await receive
+            time_manager.start_move()
+            # stop searching (pondering on the opponent's time or an outdated position) before we touch the tree
+            result = await stop_job(job)
+            job = None
+            if isinstance(result, int) and result:
+                print(f"pondered {result} iterations")
+            if(server_msg is None):
+                return None  # handle "Winner X" => restart model
+
+            last_move = server_msg.get("last_move", None)
+            state = server_msg.get("game_state", None)
+            player = server_msg.get("player", None)
+
+
+            if(last_move == None or state == None):
+                print("No message from server...")
+
+            print(last_move) #debugging
+            print(state) # debugging
+
+            # state = (global_state x, global state o, local state x, local state o, currentplayer, currentboard, winner)
+            game_state = client.parse_server_msg(last_move,player,state)
+            if GRF.stonesPlaced(*game_state) <= 1:
+                # first move of a new game, reset the clock
+                time_manager.new_game()
+                time_manager.start_move()
+                previous = None
+            game_state = apply_last_move(previous, last_move, game_state)
+            if game_state[-1] is not None:
+                # the opponent's move ended the game, wait for the server to say so
+                receive = asyncio.ensure_future(client.receive_move_message_or_none())
+                continue
+
+            # calc move, cancelled if the server sends something else meanwhile
+            job = start_job(executor, engine.best_move, game_state, None)
+            receive = asyncio.ensure_future(client.receive_move_message_or_none())
+            await asyncio.wait((job[1], receive), return_when=asyncio.FIRST_COMPLETED)
+            if receive.done():
+                print("new message from server, search cancelled")
+                continue
+            my_move = job[1].result()
+            job = None
+            if my_move is None:
+                print("engine found no move, playing a random one")
+                my_move = random.choice(GRF.getPossibleMoves(*game_state))
+
+            # Make a move
+            previous = GRF.move(*game_state, *my_move)
+            await client.make_move(my_move)
+            print(f"move took {time_manager.end_move():.3f}s, {time_manager.timeLeft:.3f}s left")
+
+            if ponder:
+                # keep searching the position after our move while the opponent thinks
+                job = start_job(executor, engine.ponder)
+    except websockets.ConnectionClosed:
+        print(f"Connection to {client.uri} closed.")
+    finally:
+        receive.cancel()
+        await stop_job(job)
+
+async def main(uri, game_time=60.0, latency=0.25, iteration_limit=10000, ponder=True, connections=1, workers=1):
+    # every connection gets its own engine and clock, the searches share one thread pool
+    # so a long search on one connection never delays the others or the keepalive pings
+    clients = [TicTacToeClient(uri) for _ in range(connections)]
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        games = []
+        engines = []
+        for client in clients:
+            # Connect to the server
+            await client.connect()
+            # the server sends no clock, so we keep our own for the whole game
+            time_manager = TimeManager(gameTime=game_time, latencyMargin=latency)
+            engine = selfPlayEngine.Engine(iteration_limit, timeManager=time_manager, workers=workers)
+            engines.append(engine)
+            games.append(play(client, engine, time_manager, executor, ponder))
+        await asyncio.gather(*games)
+    for engine in engines:
+        engine.close()
 
     # Disconnect from the server
-    await client.disconnect()
+    for client in clients:
+        await client.disconnect()
 
 
 
@@ -130,15 +224,17 @@ def test():
 
 
 if __name__ == "__main__":
-    test()
-'''
-
     # Argument parsing to allow passing WebSocket URI from command line
     parser = argparse.ArgumentParser(description="Connect to the Tic-Tac-Toe WebSocket server.")
     parser.add_argument("uri", help="WebSocket server URI (e.g., ws://localhost:PORT)")
+    parser.add_argument("--game-time", type=float, default=60.0, help="Thinking time for the whole game in seconds")
+    parser.add_argument("--latency", type=float, default=0.25, help="Seconds per move kept back for the network")
+    parser.add_argument("--iterations", type=int, default=10000, help="Maximum MCTS iterations per move")
+    parser.add_argument("--no-ponder", action="store_true", help="Do not search on the opponent's time")
+    parser.add_argument("--connections", type=int, default=1, help="Number of concurrent connections (games) to play")
+    parser.add_argument("--workers", type=int, default=1, help="Processes per game searching root-parallel")
 
     args = parser.parse_args()
 
     # Run the client with the provided WebSocket URI
-    asyncio.run(main(args.uri))
-'''
+    asyncio.run(main(args.uri, args.game_time, args.latency, args.iterations, not args.no_ponder, args.connections, args.workers))